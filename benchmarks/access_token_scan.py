@@ -0,0 +1,88 @@
+"""
+Throughput of the access token scan on large paged and batch responses.
+
+Compares the single-pass ACCESS_TOKEN_RE scan against the two re.sub passes
+that filter_access_tokens used to do.
+
+    PYTHONPATH=. python benchmarks/access_token_scan.py [--size-mb N]
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+
+import argparse
+import json
+import re
+import timeit
+
+from vcr_facebook.response import elide, filter_access_tokens
+
+
+def make_paged(size):
+    page = {
+        'access_token': 'A' * 200,
+        'category': 'Local Business',
+        'name': 'Foo Bar Golf Club',
+        'id': '11111111111',
+        'link': 'https://graph.facebook.com/v2.4/1/picture?access_token={0}'
+                '&type=large'.format('B' * 200),
+    }
+    count = max(1, size // len(json.dumps(page)))
+    return {
+        'data': [page] * count,
+        'paging': {
+            'next': 'https://graph.facebook.com/v2.4/555555555/accounts?'
+                    'access_token={0}&limit=4&after=NTUy'.format('E' * 200),
+        },
+    }
+
+
+def make_batch(size):
+    item = make_paged(size // 50)
+    return [{'code': 200, 'headers': [], 'body': json.dumps(item)}] * 50
+
+
+def two_pass(response, elide_access_token, elider_prefix):
+    body = response['body']['string'].decode('utf-8')
+    body = re.sub(
+        r'((\\*")access_token\2:\s*\2)([^\\"]+)\2',
+        lambda m: ''.join([
+            m.group(1),
+            elide(m.group(3), elide_access_token, elider_prefix),
+            m.group(2),
+        ]),
+        body,
+    )
+    body = re.sub(
+        r'(access_token=)([^\\&"]+)',
+        lambda m: ''.join([
+            m.group(1),
+            elide(m.group(2), elide_access_token, elider_prefix),
+        ]),
+        body,
+    )
+    response['body']['string'] = body.encode('utf-8')
+    return response
+
+
+def throughput(fun, body, repeat=5):
+    def run():
+        fun({'body': {'string': body}}, None, 'XXX-')
+    elapsed = min(timeit.repeat(run, number=1, repeat=repeat))
+    return len(body) / elapsed / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-mb', type=float, default=4)
+    args = parser.parse_args()
+    size = int(args.size_mb * 1024 * 1024)
+
+    for kind, data in [('paged', make_paged(size)), ('batch', make_batch(size))]:
+        body = json.dumps(data).encode('utf-8')
+        print('{0} ({1:.1f} MiB)'.format(kind, len(body) / 1024.0 / 1024))
+        for name, fun in [('two-pass', two_pass),
+                          ('single-pass', filter_access_tokens)]:
+            print('  {0:>12}: {1:.1f} MB/s'.format(name, throughput(fun, body)))
+
+
+if __name__ == '__main__':
+    main()
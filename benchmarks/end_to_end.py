@@ -0,0 +1,246 @@
+"""
+Record and replay overhead of the hooks in real VCR.py cassettes.
+
+Starts a local HTTP server standing in for graph.facebook.com (connections to
+that host are redirected to it, so nothing leaves the machine) and drives
+http.client through VCR.py, recording and then replaying a cassette with and
+without the vcr_facebook hooks. Reports the time per interaction while
+recording and replaying, and the time to write and load the cassette. The
+"cached" hooks are made with request_cache_size, and keep their cache from
+recording through replay as they would in a single test run. The "deferred"
+hooks sanitize responses as the cassette is written.
+
+    PYTHONPATH=. python benchmarks/end_to_end.py [--scale N] [--rounds N] [--output FILE]
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import zlib
+from contextlib import contextmanager
+from timeit import default_timer
+
+try:
+    # python 3
+    import http.client as httplib
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit
+except ImportError:
+    # python 2
+    import httplib
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit
+
+import vcr
+
+import traffic
+import vcr_facebook
+
+
+GRAPH_HOST = 'graph.facebook.com'
+
+
+class GraphHandler(BaseHTTPRequestHandler):
+    """
+    Just enough of the Graph API to answer the interactions below. Responses
+    are built once per server, see GraphServer.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path.endswith('/feed') and 'gzip' in self.headers.get(
+                'accept-encoding', ''):
+            self.reply(self.server.responses['gzip'], gzip=True)
+        elif path.endswith('/accounts'):
+            self.reply(self.server.responses['paged'])
+        else:
+            self.reply(self.server.responses['me'])
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('content-length', 0)))
+        if self.path.rstrip('/').endswith('v2.4'):
+            self.reply(self.server.responses['batch'])
+        else:
+            self.reply(self.server.responses['upload'])
+
+    def reply(self, body, gzip=False):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('facebook-api-version', 'v2.4')
+        if gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class GraphServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, size):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), GraphHandler)
+        paged = json.dumps(traffic.make_paged_data(size)).encode('utf-8')
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.responses = {
+            'me': json.dumps({'id': '10000000000', 'name': 'Someone'})
+                  .encode('utf-8'),
+            'paged': paged,
+            'gzip': compressor.compress(paged) + compressor.flush(),
+            'batch': traffic.make_batch_response(50, size)['body']['string'],
+            'upload': b'{"id":"10000000001","post_id":"10000000000_1"}',
+        }
+
+
+@contextmanager
+def graph_server(size):
+    """
+    Run a GraphServer and send connections for graph.facebook.com to it.
+    """
+    server = GraphServer(size)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    create_connection = socket.create_connection
+    def redirect(address, *args, **kwargs):
+        if address[0] == GRAPH_HOST:
+            address = server.server_address
+        return create_connection(address, *args, **kwargs)
+    socket.create_connection = redirect
+    try:
+        yield server
+    finally:
+        socket.create_connection = create_connection
+        server.shutdown()
+        server.server_close()
+
+
+def make_interactions(scale):
+    size = int(scale * 1024 * 1024)
+    batch = traffic.make_batch_request()
+    upload = traffic.make_upload('photo', size)
+    video = traffic.make_upload('video', 16 * size)
+    me = urlsplit(traffic.make_simple_get().uri)
+    return [
+        ('GET', me.path + '?' + me.query, None, {}),
+        ('GET', '/v2.4/me/accounts?limit=25&access_token=' + traffic.TOKEN,
+         None, {}),
+        ('GET', '/v2.4/me/feed?access_token=' + traffic.TOKEN,
+         None, {'Accept-Encoding': 'gzip'}),
+        ('POST', '/v2.4/', batch.body, dict(batch.headers)),
+        ('POST', '/v2.4/me/photos', upload.body, dict(upload.headers)),
+        ('POST', '/v2.4/me/videos', video.body, dict(video.headers)),
+    ]
+
+
+def run_interactions(port, interactions):
+    # Look up HTTPConnection here rather than importing it, since VCR.py
+    # patches it on the module.
+    conn = httplib.HTTPConnection(GRAPH_HOST, port)
+    for method, path, body, headers in interactions:
+        # Native strings, so that Python 2 httplib doesn't try to decode
+        # the body to join it with the headers.
+        conn.request(str(method), str(path), body,
+                     dict((str(k), str(v)) for k, v in headers.items()))
+        conn.getresponse().read()
+    conn.close()
+
+
+def run_cassette(path, port, interactions, record_mode, vcr_kwargs):
+    """
+    Return the time to (load, run, save) a cassette.
+    """
+    my_vcr = vcr.VCR(record_mode=record_mode, **vcr_kwargs)
+    if hasattr(vcr_kwargs.get('before_record_response'), 'deferred'):
+        vcr_facebook.register_persister(my_vcr, vcr_kwargs)
+    start = default_timer()
+    cassette = my_vcr.use_cassette(path)
+    cassette.__enter__()
+    loaded = default_timer()
+    try:
+        run_interactions(port, interactions)
+    finally:
+        ran = default_timer()
+        cassette.__exit__(None, None, None)
+        saved = default_timer()
+    return loaded - start, ran - loaded, saved - ran
+
+
+def measure(port, interactions, vcr_kwargs, rounds, prefix):
+    best = {}
+    for i in range(rounds):
+        path = '{0}-{1}.yaml'.format(prefix, i)
+        record = run_cassette(path, port, interactions, 'all', vcr_kwargs)
+        replay = run_cassette(path, port, interactions, 'none', vcr_kwargs)
+        times = dict(
+            record_per_interaction=record[1] / len(interactions),
+            cassette_write=record[2],
+            cassette_load=replay[0],
+            replay_per_interaction=replay[1] / len(interactions),
+            cassette_bytes=os.path.getsize(path),
+        )
+        for k, v in times.items():
+            best[k] = min(best.get(k, v), v)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scale', type=float, default=0.25,
+                        help='size of the large bodies in MiB (videos are '
+                             '16 times this)')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--output', help='write results to this JSON file')
+    args = parser.parse_args()
+
+    interactions = make_interactions(args.scale)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with graph_server(int(args.scale * 1024 * 1024)) as server:
+            port = server.server_address[1]
+            results = dict(
+                (name, measure(port, interactions, kwargs, args.rounds,
+                               os.path.join(tmpdir, name)))
+                for name, kwargs in [
+                    ('without', {}),
+                    ('with', vcr_facebook.get_vcr_kwargs()),
+                    ('cached', vcr_facebook.get_vcr_kwargs(
+                        request_cache_size=128)),
+                    ('deferred', vcr_facebook.get_vcr_kwargs(
+                        deferred='thread')),
+                ]
+            )
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print('{0} interactions, best of {1} rounds'.format(len(interactions),
+                                                        args.rounds))
+    configs = ['without', 'with', 'cached', 'deferred']
+    print(('{:<24}' + ' {:>10}' * len(configs)).format('', *configs))
+    for key in ['record_per_interaction', 'cassette_write', 'cassette_load',
+                'replay_per_interaction']:
+        print(('{:<24}' + ' {:>8.1f}ms' * len(configs)).format(
+            key, *[results[c][key] * 1000 for c in configs]))
+    print(('{:<24}' + ' {:>8.0f}KB' * len(configs)).format(
+        'cassette_bytes',
+        *[results[c]['cassette_bytes'] / 1024.0 for c in configs]))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Time to find a live request in a large cassette.
+
+Compares VCR.py matching on method, uri, headers and raw_body (as the README
+used to suggest) against the facebook matcher, scanning every recorded
+request for the last one as VCR.py does. The facebook matcher's keys for the
+recorded requests are computed beforehand, as they are by the first lookup in
+a cassette, so that isn't timed.
+
+    PYTHONPATH=. python benchmarks/matching.py [--interactions N]
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+
+import argparse
+import copy
+import timeit
+
+import vcr
+from vcr.matchers import requests_match
+
+import traffic
+from vcr_facebook import get_vcr_kwargs
+from vcr_facebook.matchers import register_matcher, request_key
+
+
+def make_requests(count, before_record):
+    requests = []
+    for i in range(count):
+        request = traffic.make_batch_request(operations=4) if i % 2 else \
+            traffic.make_simple_get()
+        request.uri += '&n={0}'.format(i)
+        requests.append(before_record(request))
+    return requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--interactions', type=int, default=500)
+    parser.add_argument('--number', type=int, default=20)
+    args = parser.parse_args()
+
+    before_record = get_vcr_kwargs()['before_record']
+    recorded = make_requests(args.interactions, before_record)
+    for request in recorded:
+        request_key(request)
+    live = copy.deepcopy(recorded[-1])
+    delattr(live, '_vcr_facebook_key')
+
+    my_vcr = vcr.VCR()
+    register_matcher(my_vcr)
+    print('{0} recorded requests'.format(len(recorded)))
+    for name, match_on in [
+            ('method+uri+headers+raw_body',
+             ['method', 'uri', 'headers', 'raw_body']),
+            ('facebook', ['facebook']),
+    ]:
+        matchers = [my_vcr.matchers[m] for m in match_on]
+        def scan():
+            request = copy.copy(live)
+            for stored in recorded:
+                if requests_match(request, stored, matchers):
+                    return stored
+            raise AssertionError('no match')
+        elapsed = min(timeit.repeat(scan, number=args.number, repeat=3))
+        print('  {0:>28}: {1:.2f} ms per lookup'.format(
+            name, elapsed / args.number * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Peak memory and time of before_record_response per interaction.
+
+Compares the copy-on-write response copy against the full deepcopy that
+make_before_record_response used to do. Requires Python 3 for tracemalloc.
+
+    PYTHONPATH=. python benchmarks/response_memory.py [--size-mb N]
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+
+import argparse
+import copy
+import json
+import timeit
+import tracemalloc
+
+from vcr_facebook.response import make_before_record_response
+
+
+def make_response(size):
+    page = {
+        'access_token': 'A' * 200,
+        'category': 'Local Business',
+        'name': 'Foo Bar Golf Club',
+        'id': '11111111111',
+    }
+    count = max(1, size // len(json.dumps(page)))
+    data = {
+        'data': [page] * count,
+        'paging': {
+            'next': 'https://graph.facebook.com/v2.4/555555555/accounts?'
+                    'access_token={0}&limit=4&after=NTUy'.format('E' * 200),
+        },
+    }
+    return {
+        'status': {'code': 200, 'message': 'OK'},
+        'headers': {
+            'content-type': ['application/json; charset=UTF-8'],
+            'content-length': ['1'],
+            'facebook-api-version': ['v2.4'],
+        },
+        'body': {'string': json.dumps(data).encode('utf-8')},
+    }
+
+
+def measure(fun, response):
+    tracemalloc.start()
+    try:
+        fun(response)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-mb', type=float, default=4)
+    args = parser.parse_args()
+
+    before_record_response = make_before_record_response(
+        elide_access_token=None,
+        elider_prefix='XXX-',
+    )
+    response = make_response(int(args.size_mb * 1024 * 1024))
+    size = len(response['body']['string'])
+
+    results = [
+        ('deepcopy', lambda r: before_record_response(copy.deepcopy(r))),
+        ('copy-on-write', before_record_response),
+    ]
+    print('body size: {0:.1f} MiB'.format(size / 1024.0 / 1024))
+    for name, fun in results:
+        peak = measure(fun, response)
+        elapsed = min(timeit.repeat(lambda: fun(response), number=1, repeat=5))
+        print('{0:>14}: peak {1:.1f} MiB ({2:.2f}x body), {3:.1f} ms'.format(
+            name, peak / 1024.0 / 1024, float(peak) / size, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+Throughput and peak memory of the hooks and parsers on synthetic traffic.
+
+Times make_before_record and make_before_record_response on the traffic from
+traffic.py, as well as the parsers in vcr_facebook.filters on their own.
+Results can be written as JSON and compared against an earlier run. Peak
+memory needs Python 3 for tracemalloc.
+
+    PYTHONPATH=. python benchmarks/suite.py [--scale N] [--output FILE] [--compare FILE]
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+
+import argparse
+import json
+import platform
+import sys
+import time
+import zlib
+from timeit import default_timer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import traffic
+from vcr_facebook.filters import MultipartParser, QueryParser, rewrite_batch
+from vcr_facebook.request import make_before_record
+from vcr_facebook.response import make_before_record_response
+from vcr_facebook.util import identity
+
+
+def make_cases(scale):
+    mb = int(scale * 1024 * 1024)
+
+    before_record = make_before_record(
+        elide_appsecret_proof=None,
+        elide_access_token=None,
+        elide_client_secret=None,
+        elider_prefix='XXX-',
+    )
+    before_record_response = make_before_record_response(
+        elide_access_token=None,
+        elider_prefix='XXX-',
+    )
+    before_record_response_streaming = make_before_record_response(
+        elide_access_token=None,
+        elider_prefix='XXX-',
+        gzip_chunk_size=64 * 1024,
+    )
+
+    batch_body = traffic.make_batch_request().body.decode('ascii')
+    batch = QueryParser(batch_body)['batch']
+    photo_body = traffic.make_upload('photo', mb).body
+
+    def request_size(request):
+        return len(request.body) + len(request.uri)
+
+    def response_size(response):
+        return len(response['body']['string'])
+
+    def gzip_response_size(response):
+        return len(zlib.decompress(response['body']['string'],
+                                   16 + zlib.MAX_WBITS))
+
+    # name, make input, function, size of input (uncompressed)
+    return [
+        ('request.simple_get',
+         traffic.make_simple_get, before_record, request_size),
+        ('request.batch',
+         traffic.make_batch_request, before_record, request_size),
+        ('request.photo_upload',
+         lambda: traffic.make_upload('photo', mb),
+         before_record, request_size),
+        ('request.video_upload',
+         lambda: traffic.make_upload('video', 16 * mb),
+         before_record, request_size),
+        ('response.paged',
+         lambda: traffic.make_paged_response(mb),
+         before_record_response, response_size),
+        ('response.batch',
+         lambda: traffic.make_batch_response(50, mb),
+         before_record_response, response_size),
+        ('response.gzip',
+         lambda: traffic.make_paged_response(mb, gzip=True),
+         before_record_response, gzip_response_size),
+        ('response.gzip_streaming',
+         lambda: traffic.make_paged_response(mb, gzip=True),
+         before_record_response_streaming, gzip_response_size),
+        ('parser.query',
+         lambda: batch_body, lambda b: QueryParser(b).serialize(), len),
+        ('parser.batch',
+         lambda: batch, lambda b: rewrite_batch(b, identity, identity), len),
+        ('parser.multipart',
+         lambda: photo_body,
+         lambda b: bytes(MultipartParser(b).parsed), len),
+    ]
+
+
+def run_case(make_input, fun, size, repeat):
+    times = []
+    for _ in range(repeat):
+        obj = make_input()
+        start = default_timer()
+        fun(obj)
+        times.append(default_timer() - start)
+
+    peak = None
+    if tracemalloc is not None:
+        obj = make_input()
+        tracemalloc.start()
+        try:
+            fun(obj)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    nbytes = size(make_input())
+    best = min(times)
+    return dict(
+        bytes=nbytes,
+        best_s=best,
+        mean_s=sum(times) / len(times),
+        mb_per_s=nbytes / best / 1024 / 1024 if best else None,
+        peak_bytes=peak,
+    )
+
+
+def compare(results, baseline):
+    print('\ncompared with {0}:'.format(baseline['timestamp']))
+    for name, result in results.items():
+        old = baseline['results'].get(name)
+        if old and old['best_s']:
+            print('  {0:<26} {1:>6.2f}x time'.format(
+                name, result['best_s'] / old['best_s']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scale', type=float, default=1,
+                        help='size of the large bodies in MiB (videos are '
+                             '16 times this)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', help='only run cases starting with this')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='compare with this JSON file')
+    args = parser.parse_args()
+
+    results = {}
+    print('{0:<26} {1:>10} {2:>10} {3:>10} {4:>10}'.format(
+        'case', 'KiB', 'ms', 'MB/s', 'peak KiB'))
+    for name, make_input, fun, size in make_cases(args.scale):
+        if args.only and not name.startswith(args.only):
+            continue
+        r = results[name] = run_case(make_input, fun, size, args.repeat)
+        print('{0:<26} {1:>10.1f} {2:>10.2f} {3:>10.1f} {4:>10}'.format(
+            name, r['bytes'] / 1024.0, r['best_s'] * 1000, r['mb_per_s'] or 0,
+            '-' if r['peak_bytes'] is None else r['peak_bytes'] // 1024))
+
+    report = dict(
+        timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        python=platform.python_version(),
+        implementation=platform.python_implementation(),
+        argv=sys.argv[1:],
+        scale=args.scale,
+        repeat=args.repeat,
+        results=results,
+    )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+Synthetic Graph API traffic for the benchmarks.
+
+Each make_* function returns a fresh vcr Request or a response dict as VCR.py
+passes them to before_record and before_record_response, so they can be
+filtered in place. Sizes are in bytes and are approximate.
+
+The benchmarks import this module and vcr_facebook, so they're run from the
+root of the repository with it on the path, for example:
+
+    PYTHONPATH=. python benchmarks/suite.py
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+
+import io
+import json
+import os
+import random
+import zlib
+
+from vcr.request import Request
+
+from vcr_facebook.compat import quote
+
+
+GRAPH = 'https://graph.facebook.com/v2.4'
+BOUNDARY = 'e3b0c44298fc1c149afbf4c8996fb924'
+
+_random = random.Random(0)
+
+
+def make_token(length=180):
+    alphabet = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+    return ''.join(_random.choice(alphabet) for _ in range(length))
+
+
+TOKEN = make_token()
+PAGE_TOKEN = make_token()
+PROOF = '%064x' % _random.getrandbits(256)
+
+
+def request_headers(content_type=None):
+    headers = {
+        'Accept': '*/*',
+        'Accept-Encoding': 'gzip, deflate',
+        'User-Agent': 'python-requests/2.7.0',
+    }
+    if content_type:
+        headers['Content-Type'] = content_type
+    return headers
+
+
+def response(data, gzip=False):
+    body = data if isinstance(data, bytes) else json.dumps(data).encode('utf-8')
+    headers = {
+        'content-type': ['application/json; charset=UTF-8'],
+        'facebook-api-version': ['v2.4'],
+    }
+    if gzip:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress(body) + compressor.flush()
+        headers['content-encoding'] = ['gzip']
+    headers['content-length'] = [str(len(body))]
+    return {
+        'status': {'code': 200, 'message': 'OK'},
+        'headers': headers,
+        'body': {'string': body},
+    }
+
+
+def make_simple_get():
+    return Request(
+        'GET',
+        '{0}/me?fields=id,name,email&access_token={1}&appsecret_proof={2}'
+        .format(GRAPH, TOKEN, PROOF),
+        b'', request_headers())
+
+
+def make_page(i):
+    return {
+        'id': str(10000000000 + i),
+        'name': 'Page {0}'.format(i),
+        'category': 'Local Business',
+        'access_token': PAGE_TOKEN,
+        'link': '{0}/{1}/picture?type=large&access_token={2}'.format(
+            GRAPH, 10000000000 + i, TOKEN),
+        'perms': ['ADMINISTER', 'EDIT_PROFILE', 'CREATE_CONTENT'],
+    }
+
+
+def make_paged_data(size):
+    one = len(json.dumps(make_page(0)))
+    return {
+        'data': [make_page(i) for i in range(max(1, size // one))],
+        'paging': {
+            'cursors': {'before': 'MTAw', 'after': 'MjAw'},
+            'next': '{0}/me/accounts?access_token={1}&limit=25&after=MjAw'
+                    .format(GRAPH, TOKEN),
+        },
+    }
+
+
+def make_paged_response(size, gzip=False):
+    return response(make_paged_data(size), gzip)
+
+
+def make_batch_request(operations=50):
+    batch = []
+    for i in range(operations):
+        if i % 2:
+            batch.append({
+                'method': 'POST',
+                'relative_url': '{0}/feed'.format(10000000000 + i),
+                'body': 'message={0}&access_token={1}'.format(
+                    quote('Hello from operation {0}'.format(i)), PAGE_TOKEN),
+            })
+        else:
+            batch.append({
+                'method': 'GET',
+                'relative_url': '{0}/feed?limit=25&access_token={1}'.format(
+                    10000000000 + i, PAGE_TOKEN),
+            })
+    body = 'access_token={0}&include_headers=false&batch={1}'.format(
+        TOKEN, quote(json.dumps(batch), safe=''))
+    return Request('POST', GRAPH + '/', body.encode('ascii'),
+                   request_headers('application/x-www-form-urlencoded'))
+
+
+def make_batch_response(operations=50, size=1024 * 1024):
+    body = json.dumps(make_paged_data(size // operations))
+    return response([
+        {'code': 200, 'headers': [], 'body': body}
+        for _ in range(operations)
+    ])
+
+
+def make_multipart_body(fields, filename, content, boundary=BOUNDARY):
+    out = io.BytesIO()
+    for name, value in fields:
+        out.write('--{0}\r\nContent-Disposition: form-data; name="{1}"\r\n\r\n'
+                  '{2}\r\n'.format(boundary, name, value).encode('utf-8'))
+    out.write('--{0}\r\nContent-Disposition: form-data; name="source"; '
+              'filename="{1}"\r\n\r\n'.format(boundary, filename)
+              .encode('utf-8'))
+    out.write(content)
+    out.write('\r\n--{0}--\r\n'.format(boundary).encode('utf-8'))
+    return out.getvalue()
+
+
+def make_upload(kind='photo', size=1024 * 1024):
+    """
+    A multipart/form-data photo or video upload, with size random bytes of
+    content.
+    """
+    filename = 'upload.jpg' if kind == 'photo' else 'upload.mp4'
+    path = 'photos' if kind == 'photo' else 'videos'
+    body = make_multipart_body(
+        [('access_token', TOKEN), ('appsecret_proof', PROOF),
+         ('caption', 'A synthetic {0}'.format(kind))],
+        filename, os.urandom(size))
+    return Request(
+        'POST', '{0}/me/{1}'.format(GRAPH, path), body,
+        request_headers('multipart/form-data; boundary=' + BOUNDARY))
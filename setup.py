@@ -43,4 +43,9 @@ setup(
     keywords='vcrpy vcr.py facebook testing mock http'.split(),
     packages=find_packages(exclude=['tests']),
     install_requires=install_requires,
+    entry_points={
+        'console_scripts': [
+            'vcr-facebook-sanitize = vcr_facebook.cli:main',
+        ],
+    },
 )
@@ -0,0 +1,43 @@
+from __future__ import absolute_import, unicode_literals, print_function
+
+import threading
+
+import pytest
+
+from vcr_facebook.cache import LRUCache
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    assert cache.get('a', lambda: 1) == 1
+    assert cache.get('b', lambda: 2) == 2
+    assert cache.get('a', lambda: 3) == 1   # hit, a is now most recent
+    assert cache.get('c', lambda: 4) == 4   # evicts b
+    assert cache.get('b', lambda: 5) == 5   # evicts a
+    assert cache.stats() == dict(hits=1, misses=4, evictions=2, size=2,
+                                 maxsize=2)
+
+
+def test_lru_cache_maxsize():
+    with pytest.raises(ValueError):
+        LRUCache(0)
+
+
+def test_lru_cache_threads():
+    cache = LRUCache(10)
+
+    def run():
+        for i in range(1000):
+            cache.get(i % 20, lambda: i % 20)
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    stats = cache.stats()
+    assert stats['hits'] + stats['misses'] == 4000
+    assert stats['size'] == 10
+    for k in range(20):
+        assert cache.get(k, lambda: k) == k
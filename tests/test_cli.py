@@ -0,0 +1,141 @@
+from __future__ import absolute_import, unicode_literals, print_function
+
+import json
+import os
+
+import pytest
+from vcr.request import Request
+from vcr.serialize import deserialize, serialize
+from vcr.serializers import jsonserializer, yamlserializer
+
+from vcr_facebook import cli
+
+from .test_request import get_multipart_body
+from .test_response import (get_paged_response_data, get_response_headers,
+                            mock_response, new_paged_response_data)
+
+
+def write_cassette(path, serializer):
+    request = Request(
+        'GET',
+        'https://graph.facebook.com/v2.4/me/accounts?access_token=AAAAAAAAAAAAAAAAAAAAAAAAAAAA',
+        b'', {})
+    response = mock_response(headers=get_response_headers(),
+                             data=get_paged_response_data())
+    with open(path, 'w') as f:
+        f.write(serialize(dict(requests=[request], responses=[response]),
+                          serializer))
+
+
+def read_cassette(path, serializer):
+    with open(path) as f:
+        return deserialize(f.read(), serializer)
+
+
+@pytest.mark.parametrize('jobs', ['1', '2'])
+def test_cli(tmpdir, capsys, jobs):
+    yaml_path = str(tmpdir.join('one.yaml'))
+    json_path = str(tmpdir.join('sub', 'two.json'))
+    os.mkdir(os.path.dirname(json_path))
+    write_cassette(yaml_path, yamlserializer)
+    write_cassette(json_path, jsonserializer)
+
+    assert cli.main(['--check', '-j', jobs, str(tmpdir)]) == 1
+    out = capsys.readouterr()[0]
+    assert 'one.yaml: would sanitize, 1 interactions' in out
+    assert 'two.json: would sanitize, 1 interactions' in out
+    assert 'elided.access_token=' in out
+
+    assert cli.main(['-j', jobs, str(tmpdir)]) == 0
+    for path, serializer in [(yaml_path, yamlserializer),
+                             (json_path, jsonserializer)]:
+        requests, responses = read_cassette(path, serializer)
+        assert requests[0].uri == 'https://graph.facebook.com/v2.4/me/accounts?access_token=XXX-35ea99843da5ff0639992be381c5b77a'
+        data = json.loads(responses[0]['body']['string'].decode('utf-8'))
+        assert data == new_paged_response_data()
+    assert not [n for n in os.listdir(str(tmpdir)) if n.endswith('.tmp')]
+
+    # Sanitizing again changes nothing.
+    capsys.readouterr()
+    assert cli.main(['--check', '-j', jobs, str(tmpdir)]) == 0
+    assert 'would sanitize' not in capsys.readouterr()[0]
+
+
+def test_cli_error(tmpdir, capsys):
+    path = tmpdir.join('broken.yaml')
+    path.write('not a cassette')
+    assert cli.main([str(path)]) == 1
+    assert 'broken.yaml: error' in capsys.readouterr()[0]
+    assert path.read() == 'not a cassette'
+
+
+def test_cli_upload_hash(tmpdir, capsys):
+    boundary = b'd5b7a1ccf3574e36bb83bdcaf5f32e6b'
+    request = Request(
+        'POST', 'https://graph.facebook.com/v2.4/me/photos',
+        get_multipart_body(boundary=boundary,
+                           access_token=b'AAAAAAAAAAAAAAAAAAAAAAAAAAAA',
+                           appsecret_proof=b'BBBBBBBBBBBBBBBBBBBBBBBBBBBB',
+                           source=b'x' * 1000),
+        {'Content-Type': 'multipart/form-data; boundary=' +
+         boundary.decode('ascii')})
+    response = mock_response(headers=get_response_headers(),
+                             data=get_paged_response_data())
+    path = str(tmpdir.join('upload.yaml'))
+    with open(path, 'w') as f:
+        f.write(serialize(dict(requests=[request], responses=[response]),
+                          yamlserializer))
+
+    assert cli.main(['--upload-hash', 'sha512', path]) == 0
+    assert 'upload.yaml: sanitized' in capsys.readouterr()[0]
+    # The sha512 digest is longer than the smallest upload that's hashed,
+    # but isn't hashed again.
+    assert cli.main(['--check', '--upload-hash', 'sha512', path]) == 0
+    assert 'upload.yaml: unchanged' in capsys.readouterr()[0]
+
+
+FIELDS_MODULE = '''
+import vcr_facebook
+
+def elide(value):
+    return 'custom'
+
+fields = vcr_facebook.default_fields(elide_access_token=elide)
+fields.add('code')
+'''
+
+
+@pytest.mark.parametrize('jobs', ['1', '2'])
+def test_cli_fields(tmpdir, monkeypatch, jobs):
+    module = 'cassette_fields_{0}'.format(jobs)
+    tmpdir.join(module + '.py').write(FIELDS_MODULE)
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.syspath_prepend(str(tmpdir))
+    paths = []
+    for name in ['one.yaml', 'two.yaml']:
+        path = str(tmpdir.join(name))
+        request = Request(
+            'GET',
+            'https://graph.facebook.com/v2.4/oauth/access_token'
+            '?code=CCCCCCCCCCCCCCCCCCCCCCCCCCCC'
+            '&access_token=AAAAAAAAAAAAAAAAAAAAAAAAAAAA', b'', {})
+        response = mock_response(headers=get_response_headers(),
+                                 data=get_paged_response_data())
+        with open(path, 'w') as f:
+            f.write(serialize(dict(requests=[request], responses=[response]),
+                              yamlserializer))
+        paths.append(path)
+
+    assert cli.main(['-j', jobs, '--fields', module + ':fields'] + paths) == 0
+    for path in paths:
+        requests, responses = read_cassette(path, yamlserializer)
+        assert requests[0].uri == (
+            'https://graph.facebook.com/v2.4/oauth/access_token'
+            '?code=XXX-5e086c22567b9e335e6914095057b5f2'
+            '&access_token=XXX-custom')
+
+
+def test_cli_fields_error(tmpdir, capsys):
+    with pytest.raises(SystemExit):
+        cli.main(['--fields', 'no_such_module:fields', str(tmpdir)])
+    assert 'No module named' in capsys.readouterr()[1]
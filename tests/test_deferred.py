@@ -0,0 +1,80 @@
+from __future__ import absolute_import, unicode_literals, print_function
+
+import copy
+import json
+
+import pytest
+import vcr
+from mock import MagicMock as Mock
+
+import vcr_facebook
+
+from .test_response import (get_paged_response_data, get_response_headers,
+                            mock_response, new_paged_response_data)
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_deferred(executor):
+    kwargs = vcr_facebook.get_vcr_kwargs(deferred=executor)
+    my_vcr = Mock()
+    persister = vcr_facebook.register_persister(my_vcr, kwargs)
+    my_vcr.register_persister.assert_called_once_with(persister)
+
+    response = mock_response(headers=get_response_headers(),
+                             data=get_paged_response_data())
+    original = copy.deepcopy(response)
+    other = mock_response(headers=get_response_headers(),
+                          data=get_paged_response_data())
+
+    # Nothing happens until the cassette is saved.
+    assert my_vcr.before_record_response(response) is response
+    assert response == original
+
+    cassette_dict = {'requests': [None, None], 'responses': [other, response]}
+    persister.save_cassette('cassette.yaml', cassette_dict, 'yaml')
+    my_vcr.persister.save_cassette.assert_called_once_with(
+        'cassette.yaml', cassette_dict, 'yaml')
+
+    # Every response in the cassette is sanitized, whether or not it went
+    # through the hook, and sanitizing again changes nothing.
+    for r in [response, other]:
+        data = json.loads(r['body']['string'].decode('utf-8'))
+        assert data == new_paged_response_data()
+    saved = copy.deepcopy(cassette_dict)
+    persister.save_cassette('cassette.yaml', cassette_dict, 'yaml')
+    assert cassette_dict == saved
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_deferred_without_persister(executor):
+    # Without a DeferredPersister, responses are sanitized as they're
+    # recorded rather than saved with their tokens.
+    kwargs = vcr_facebook.get_vcr_kwargs(deferred=executor)
+    response = mock_response(headers=get_response_headers(),
+                             data=get_paged_response_data())
+    response = kwargs['before_record_response'](response)
+    data = json.loads(response['body']['string'].decode('utf-8'))
+    assert data == new_paged_response_data()
+
+
+def test_deferred_shared_kwargs():
+    # Only the VCR with the DeferredPersister leaves responses to it.
+    kwargs = vcr_facebook.get_vcr_kwargs(deferred='thread')
+    deferred_vcr = vcr.VCR(**kwargs)
+    inline_vcr = vcr.VCR(**kwargs)
+    vcr_facebook.register_persister(deferred_vcr, kwargs)
+
+    for my_vcr, sanitized in [(deferred_vcr, False), (inline_vcr, True)]:
+        before_record_response = my_vcr.get_merged_config()[
+            'before_record_response']
+        response = mock_response(headers=get_response_headers(),
+                                 data=get_paged_response_data())
+        response = before_record_response(response)
+        data = json.loads(response['body']['string'].decode('utf-8'))
+        assert (data == new_paged_response_data()) is sanitized
+
+
+def test_deferred_process_unpicklable():
+    with pytest.raises(ValueError):
+        vcr_facebook.get_vcr_kwargs(deferred='process',
+                                    elide_access_token=lambda value: 'x')
@@ -0,0 +1,71 @@
+from __future__ import absolute_import, unicode_literals, print_function
+
+import pytest
+
+from vcr_facebook.fields import (BODY, RESPONSE, SCOPES, URL, FieldRegistry,
+                                 default_fields)
+from vcr_facebook.filters import QueryParser
+from vcr_facebook.request import make_before_record
+from vcr_facebook.response import make_before_record_response
+
+from .test_request import MockRequest
+from .test_response import get_response_headers, mock_response
+
+
+def test_registry():
+    fields = default_fields()
+    assert [f.name for f in fields] == [
+        'appsecret_proof', 'access_token', 'input_token', 'client_secret']
+    fields.add('fb_exchange_token', scopes=SCOPES)
+    fields.add('appsecret_proof', scopes=[URL])
+    assert [f.name for f in fields][0] == 'appsecret_proof'
+    assert fields['appsecret_proof'].scopes == (URL,)
+    assert 'fb_exchange_token' in fields
+    fields.remove('fb_exchange_token')
+    assert len(fields) == 4
+    with pytest.raises(ValueError):
+        fields.add('code', scopes=['headers'])
+
+    matcher = default_fields().compile('XXX-')
+    assert matcher.markers(URL) == matcher.markers(BODY)
+    assert matcher.markers(RESPONSE) == ('access_token',)
+
+
+def test_requires():
+    calls = []
+    def elide_appsecret_proof(proof, token):
+        calls.append((proof, token))
+        return 'PROOF'
+    fields = default_fields(elide_appsecret_proof=elide_appsecret_proof)
+    query = fields.compile('XXX-').filter(URL)(
+        QueryParser('appsecret_proof=abc&access_token=def'))
+    assert calls == [('abc', 'def')]
+    assert query['appsecret_proof'] == 'XXX-PROOF'
+    assert query['access_token'] == 'XXX-4ed9407630eb1000c0f6b63842defa7d'
+
+
+def test_extra_field():
+    fields = FieldRegistry(default_fields())
+    fields.add('fb_exchange_token', lambda token: 'EXCHANGE', scopes=SCOPES)
+    matcher = fields.compile('XXX-')
+
+    before_record = make_before_record(None, None, None, 'XXX-',
+                                       fields=matcher)
+    request = before_record(MockRequest(
+        url='https://graph.facebook.com/oauth/access_token?'
+            'grant_type=fb_exchange_token&fb_exchange_token=abc&input_token=def',
+    ))
+    assert request.uri == (
+        'https://graph.facebook.com/oauth/access_token?'
+        'grant_type=fb_exchange_token&fb_exchange_token=XXX-EXCHANGE'
+        '&input_token=XXX-4ed9407630eb1000c0f6b63842defa7d')
+
+    before_record_response = make_before_record_response(None, 'XXX-',
+                                                         fields=matcher)
+    response = before_record_response(mock_response(
+        headers=get_response_headers(),
+        data={'fb_exchange_token': 'abc', 'access_token': 'def',
+              'next': 'https://graph.facebook.com/?fb_exchange_token=abc'},
+    ))
+    assert response['body']['string'].count(b'XXX-EXCHANGE') == 2
+    assert b'XXX-4ed9407630eb1000c0f6b63842defa7d' in response['body']['string']
@@ -0,0 +1,93 @@
+from __future__ import absolute_import, unicode_literals, print_function
+
+import json
+
+from vcr_facebook import filters
+from vcr_facebook.compat import quote
+from vcr_facebook.filters import (JSON, MULTIPART, OPAQUE, QUERY, QueryParser,
+                                  body_format, make_body_filter,
+                                  make_elider_filter, rewrite_batch)
+
+
+def test_body_format():
+    assert body_format('application/x-www-form-urlencoded') == QUERY
+    assert body_format('multipart/form-data; boundary=abc') == MULTIPART
+    assert body_format('Multipart/Form-Data; boundary=def') == MULTIPART
+    assert body_format('application/json; charset=UTF-8') == JSON
+    assert body_format('application/ld+json') == JSON
+    assert body_format('image/jpeg') == OPAQUE
+    assert body_format('application/octet-stream') == OPAQUE
+    assert body_format('') is None
+    assert body_format('text/plain') is None
+
+    # The cache is keyed on the header as it is, but not for multipart,
+    # where the boundary differs every time.
+    assert filters._body_formats['application/json; charset=UTF-8'] == JSON
+    assert body_format('application/json; charset=UTF-8') == JSON
+    assert 'multipart/form-data; boundary=abc' not in filters._body_formats
+
+
+def test_body_filter_dispatch():
+    body_filter = make_body_filter([
+        make_elider_filter('access_token', None, 'XXX-'),
+    ])
+    body = 'access_token=AAAAAAAAAAAAAAAAAAAAAAAAAAAA'
+    elided = 'access_token=XXX-35ea99843da5ff0639992be381c5b77a'
+    assert body_filter(body) == elided
+    assert body_filter(body, QUERY) == elided
+    assert body_filter(body, JSON) == body
+    assert body_filter(body, OPAQUE) == body
+    assert body_filter(body, MULTIPART) == body
+
+
+def test_query_parser_spans():
+    body_filter = make_body_filter([
+        make_elider_filter('access_token', None, 'XXX-'),
+    ])
+    body = 'message=hello+world%21&access_token=AAAAAAAAAAAAAAAAAAAAAAAAAAAA&fields=a,b%2Cc'
+    elided = body.replace('AAAAAAAAAAAAAAAAAAAAAAAAAAAA',
+                          'XXX-35ea99843da5ff0639992be381c5b77a')
+    assert body_filter(body) == elided
+    assert body_filter(body.encode('ascii')) == elided.encode('ascii')
+
+
+def test_query_parser_edits():
+    query = QueryParser('a=1&b=2&a=3')
+    assert dict(query) == {'a': '3', 'b': '2'}
+    query['a'] = 'x y'
+    query['c'] = '4'
+    assert query.serialize() == 'a=x%20y&b=2&a=x%20y&c=4'
+    del query['b']
+    assert query.serialize() == 'a=x%20y&c=4'
+
+    assert not QueryParser('not a query')
+
+
+def test_query_parser_repeated_key():
+    # Setting a repeated key to its last value still changes the others.
+    query = QueryParser('access_token=REALTOKEN123&access_token=XXX-abc')
+    query['access_token'] = 'XXX-abc'
+    assert query.is_dirty()
+
+    query = QueryParser('access_token=XXX-abc&b=2')
+    query['access_token'] = 'XXX-abc'
+    assert not query.is_dirty()
+
+
+def test_batch_rewrite():
+    body_filter = make_body_filter([
+        make_elider_filter('access_token', None, 'XXX-'),
+    ])
+    batch = (
+        '[{"method": "GET", "relative_url": "me?access_token=AAAAAAAAAAAAAAAAAAAAAAAAAAAA"},'
+        ' {"method": "POST", "relative_url": "me/feed",'
+        ' "body": "message=\\"relative_url\\"&access_token=AAAAAAAAAAAAAAAAAAAAAAAAAAAA"},'
+        ' {"method":"GET","relative_url":"me/friends"}]'
+    )
+    body = 'batch=' + quote(batch, safe='')
+    filtered = QueryParser(body_filter(body))['batch']
+    assert filtered == batch.replace('AAAAAAAAAAAAAAAAAAAAAAAAAAAA',
+                                     'XXX-35ea99843da5ff0639992be381c5b77a')
+    assert json.loads(filtered)[1]['body'].startswith('message="relative_url"&')
+
+    assert rewrite_batch(batch, lambda u: u, lambda b: b) is batch
@@ -0,0 +1,85 @@
+from __future__ import absolute_import, unicode_literals, print_function
+
+import io
+
+import pytest
+import vcr
+from mock import MagicMock as Mock
+from vcr.request import Request
+from vcr.serialize import serialize
+from vcr.serializers import yamlserializer
+
+import vcr_facebook
+from vcr_facebook.matchers import facebook, register_matcher, request_key
+
+from .test_request import MockRequest
+
+
+def make_request(url, body='', content_type='application/x-www-form-urlencoded'):
+    return MockRequest(method='POST', url=url, body=body,
+                       headers={'content-type': content_type})
+
+
+def test_request_key():
+    a = make_request('https://graph.facebook.com/v2.4/me?b=2&a=1',
+                     'message=hi&access_token=XXX-1')
+    b = make_request('https://graph.facebook.com:443/v2.4/me?a=1&b=2',
+                     b'access_token=XXX-1&message=hi')
+    facebook(a, b)
+    assert request_key(a) is request_key(a)
+
+    # The key follows changes to the request.
+    key = request_key(a)
+    a.uri += '&c=3'
+    assert request_key(a) != key
+
+    for other in [
+            make_request('https://graph.facebook.com/v2.4/me?a=1&b=3',
+                         'message=hi&access_token=XXX-1'),
+            make_request('https://graph.facebook.com/v2.4/me?b=2&a=1',
+                         'message=hi&access_token=XXX-2'),
+            make_request('https://graph.facebook.com/v2.4/me?b=2&a=1',
+                         'message=hi&access_token=XXX-1', 'text/plain'),
+    ]:
+        with pytest.raises(AssertionError):
+            facebook(a, other)
+
+    # Only form bodies are compared without regard to order.
+    assert (request_key(make_request('https://graph.facebook.com/', 'a&b', '')) !=
+            request_key(make_request('https://graph.facebook.com/', 'b&a', '')))
+
+
+def test_request_key_stream():
+    # VCR.py makes a new stream each time the body of a request made with a
+    # file or iterable is read.
+    headers = {'content-type': 'application/x-www-form-urlencoded'}
+    url = 'https://graph.facebook.com/v2.4/me/feed'
+    key = request_key(Request('POST', url, b'b=2&a=1', headers))
+    for body in [io.BytesIO(b'a=1&b=2'), iter([b'a=1', b'&b=2'])]:
+        request = Request('POST', url, body, headers)
+        assert request_key(request) == key
+        assert request_key(request) is request_key(request)
+
+
+def test_register_matcher():
+    my_vcr = Mock()
+    register_matcher(my_vcr)
+    my_vcr.register_matcher.assert_called_once_with('facebook', facebook)
+
+
+def test_replay_unsanitized_cassette(tmpdir):
+    # A cassette recorded without the hooks is sanitized by VCR.py as it
+    # loads, after the recorded requests are read.
+    url = 'https://graph.facebook.com/v2.4/me?access_token=RAWTOKEN'
+    response = {'status': {'code': 200, 'message': 'OK'}, 'headers': {},
+                'body': {'string': b'{}'}}
+    path = str(tmpdir.join('raw.yaml'))
+    with open(path, 'w') as f:
+        f.write(serialize(dict(requests=[Request('GET', url, b'', {})],
+                               responses=[response]), yamlserializer))
+
+    my_vcr = vcr.VCR(record_mode='none', **vcr_facebook.get_vcr_kwargs(
+        dict(match_on=['facebook'])))
+    register_matcher(my_vcr)
+    with my_vcr.use_cassette(path) as cassette:
+        assert cassette.can_play_response_for(Request('GET', url, b'', {}))
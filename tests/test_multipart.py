@@ -0,0 +1,94 @@
+from __future__ import absolute_import, unicode_literals, print_function
+
+import pytest
+
+from vcr_facebook.multipart import MultiPartFormData, MultiPartPart, iter_multipart
+
+
+BODY = (b'--xxxboundary123\r\n'
+        b'Content-Disposition: form-data; name="access_token"\r\n'
+        b'\r\n'
+        b'abcde12345abcde12345\r\n'
+        b'--xxxboundary123\r\n'
+        b'Content-Disposition: form-data; name="source"; filename="a.jpg"\r\n'
+        b'Content-Type: image/jpeg\r\n'
+        b'\r\n'
+        b'\xff\xd8\xff\xe0\r\n\r\n\x00\x01\r\n'
+        b'--xxxboundary123--\r\n')
+
+
+def test_round_trip():
+    parts = MultiPartFormData(BODY)
+    assert parts.boundary == b'xxxboundary123'
+    assert len(parts) == 2
+    assert bytes(parts) == BODY
+
+
+def test_get_set():
+    parts = MultiPartFormData(BODY)
+    assert 'access_token' in parts
+    assert 'appsecret_proof' not in parts
+    assert parts.get('appsecret_proof') is None
+    assert parts['access_token'].content == b'abcde12345abcde12345'
+    assert parts['source'].content == b'\xff\xd8\xff\xe0\r\n\r\n\x00\x01'
+    assert bytes(parts['source'].content_view) == parts['source'].content
+
+    parts['access_token'].content = 'redacted'
+    parts.boundary = b'yyyboundary456'
+    assert bytes(parts) == (BODY.replace(b'abcde12345abcde12345', b'redacted')
+                                .replace(b'xxxboundary123', b'yyyboundary456'))
+
+
+def test_header():
+    part = MultiPartPart(b'Content-Disposition: form-data; name="a"\r\n\r\nb')
+    part.header = b'Content-Disposition: form-data; name="c"'
+    assert bytes(part) == b'Content-Disposition: form-data; name="c"\r\n\r\nb'
+
+
+def test_not_multipart():
+    with pytest.raises(ValueError):
+        MultiPartFormData(b'access_token=abcde12345abcde12345')
+    with pytest.raises(ValueError):
+        MultiPartFormData(BODY[:-4])
+
+
+def test_index():
+    body = BODY.replace(b'name="source"', b'name="access_token"')
+    parts = MultiPartFormData(body)
+    assert parts.index == {b'access_token': [0, 1]}
+    assert parts.find('access_token') == 0
+    assert parts.parts[1].filename == b'a.jpg'
+    assert parts.parts[0].filename is None
+
+    parts.parts[0].header = b'Content-Disposition: form-data; name="message"'
+    assert parts.index == {b'message': [0], b'access_token': [1]}
+    assert parts['access_token'] is parts.parts[1]
+
+    parts.parts = parts.parts[:1]
+    assert 'access_token' not in parts
+
+
+def test_iter_multipart():
+    for size in [1, 5, 16, 1000]:
+        chunks = [BODY[i:i + size] for i in range(0, len(BODY), size)]
+        events = []
+        for kind, data in iter_multipart(chunks):
+            if kind == 'content' and events[-1][0] == 'content':
+                events[-1] = (kind, events[-1][1] + data)
+            else:
+                events.append((kind, data))
+        assert events == [
+            ('boundary', b'xxxboundary123'),
+            ('header', b'Content-Disposition: form-data; name="access_token"'),
+            ('content', b'abcde12345abcde12345'),
+            ('end', None),
+            ('header', b'Content-Disposition: form-data; name="source"; filename="a.jpg"\r\n'
+                       b'Content-Type: image/jpeg'),
+            ('content', b'\xff\xd8\xff\xe0\r\n\r\n\x00\x01'),
+            ('end', None),
+        ]
+
+
+def test_iter_multipart_truncated():
+    with pytest.raises(ValueError):
+        list(iter_multipart([BODY[:-30]]))
@@ -1,9 +1,15 @@
 from __future__ import absolute_import, unicode_literals, print_function
 
 import copy
+import hashlib
+import io
 import json
 import os
+import zlib
+
+import pytest
 from mock import MagicMock as Mock
+from vcr.request import Request
 
 try:
     # python 3
@@ -13,7 +19,9 @@ except ImportError:
     from urllib import quote
     from urlparse import parse_qsl, urlsplit
 
-from vcr_facebook.request import make_before_record
+from vcr_facebook.cache import LRUCache
+from vcr_facebook.multipart import MultiPartFormData
+from vcr_facebook.request import hash_upload, make_before_record, make_upload_filter
 
 
 def test_simple_request():
@@ -80,6 +88,397 @@ def test_batch_request_idempotent():
     _test_request(request, new_request)
 
 
+def test_repeated_access_token():
+    # A real token next to one that's already elided is still elided.
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    request = MockRequest(
+        url='https://graph.facebook.com/v2.4/me?access_token=AAAAAAAAAAAAAAAAAAAAAAAAAAAA&access_token=XXX-abc',
+        method='POST', headers=headers,
+        body='access_token=AAAAAAAAAAAAAAAAAAAAAAAAAAAA&access_token=XXX-abc',
+    )
+    new_request = MockRequest(
+        url='https://graph.facebook.com/v2.4/me?access_token=XXX-abc&access_token=XXX-abc',
+        method='POST', headers=headers,
+        body='access_token=XXX-abc&access_token=XXX-abc',
+    )
+    _test_request(request, new_request)
+
+
+def test_multipart_request():
+    headers = get_request_headers()
+    headers.update({
+        'content-type': 'multipart/form-data; boundary=d5b7a1ccf3574e36bb83bdcaf5f32e6b',
+    })
+    body = get_multipart_body(
+        boundary=b'd5b7a1ccf3574e36bb83bdcaf5f32e6b',
+        access_token=b'AAAAAAAAAAAAAAAAAAAAAAAAAAAA',
+        appsecret_proof=b'BBBBBBBBBBBBBBBBBBBBBBBBBBBB',
+        source=b'\xff' * 200,
+    )
+    request = MockRequest(
+        method='POST',
+        url='https://graph.facebook.com/v2.4/me/photos',
+        headers=headers,
+        body=body,
+    )
+    new_headers = dict(headers, **{
+        'content-type': 'multipart/form-data; boundary=xxBOUNDARYxxBOUNDARYxxBOUNDARYxx',
+    })
+    new_body = get_multipart_body(
+        boundary=b'xxBOUNDARYxxBOUNDARYxxBOUNDARYxx',
+        access_token=b'XXX-35ea99843da5ff0639992be381c5b77a',
+        appsecret_proof=b'XXX-f41362dca518350fa6281cd27b14bf68',
+        source=b'd9d210da21772381c487e43b353da8bc',
+    )
+    new_request = MockRequest(
+        method='POST',
+        url='https://graph.facebook.com/v2.4/me/photos',
+        headers=new_headers,
+        body=new_body,
+    )
+    _test_request(request, new_request)
+    return request, new_request  # for test_multipart_request_idempotent
+
+
+def test_multipart_repeated_access_token():
+    # A real token in a later part with the same name is elided too.
+    boundary = b'xxBOUNDARYxxBOUNDARYxxBOUNDARYxx'
+    headers = dict(get_request_headers(), **{
+        'content-type': 'multipart/form-data; boundary=' +
+                        boundary.decode('ascii'),
+    })
+
+    def body(*tokens):
+        return b''.join(
+            [b''.join([b'--', boundary, b'\r\n',
+                       b'Content-Disposition: form-data; name="access_token"\r\n',
+                       b'\r\n',
+                       token, b'\r\n'])
+             for token in tokens] + [b'--', boundary, b'--\r\n'])
+
+    request = MockRequest(
+        method='POST',
+        url='https://graph.facebook.com/v2.4/me/photos',
+        headers=headers,
+        body=body(b'XXX-abc', b'TOKEN2TOKEN2TOKEN2TOKEN2'),
+    )
+    new_request = MockRequest(
+        method='POST',
+        url='https://graph.facebook.com/v2.4/me/photos',
+        headers=headers,
+        body=body(b'XXX-abc', b'XXX-abc'),
+    )
+    _test_request(request, new_request)
+
+
+def test_multipart_request_idempotent():
+    request, new_request = test_multipart_request()
+    _test_request(request, new_request)
+
+
+def test_request_idempotent_unchanged():
+    # Nothing is re-serialized on the second pass, so the very same body and
+    # uri objects come back.
+    for test in [test_simple_request, test_batch_request, test_multipart_request]:
+        request, _ = test()
+        body, uri = request.body, request.uri
+        request = make_before_record(
+            elide_appsecret_proof=None,
+            elide_access_token=None,
+            elide_client_secret=None,
+            elider_prefix='XXX-',
+        )(request)
+        assert request.body is body
+        assert request.uri is uri
+
+
+def test_multipart_request_stream():
+    request, new_request = test_multipart_request()
+    body = get_multipart_body(
+        boundary=b'd5b7a1ccf3574e36bb83bdcaf5f32e6b',
+        access_token=b'AAAAAAAAAAAAAAAAAAAAAAAAAAAA',
+        appsecret_proof=b'BBBBBBBBBBBBBBBBBBBBBBBBBBBB',
+        source=b'\xff' * 200,
+    )
+    for stream in [io.BytesIO(body),
+                   (body[i:i + 7] for i in range(0, len(body), 7))]:
+        request.headers = get_request_headers()
+        request.headers.update({
+            'content-type': 'multipart/form-data; boundary=d5b7a1ccf3574e36bb83bdcaf5f32e6b',
+        })
+        request.body = stream
+        _test_request(request, new_request, stream_chunk_size=5)
+
+
+def test_multipart_request_stream_upload_cache():
+    cache = LRUCache(10)
+    before_record = make_before_record(
+        elide_appsecret_proof=None,
+        elide_access_token=None,
+        elide_client_secret=None,
+        elider_prefix='XXX-',
+        upload_cache=cache,
+        stream_chunk_size=64,
+    )
+    body = get_multipart_body(
+        boundary=b'd5b7a1ccf3574e36bb83bdcaf5f32e6b',
+        access_token=b'AAAAAAAAAAAAAAAAAAAAAAAAAAAA',
+        appsecret_proof=b'BBBBBBBBBBBBBBBBBBBBBBBBBBBB',
+        source=b'\xff' * 200,
+    )
+    bodies = []
+    for stream in [io.BytesIO(body), io.BytesIO(body), body]:
+        request = before_record(MockRequest(
+            method='POST',
+            url='https://graph.facebook.com/v2.4/me/photos',
+            headers={'content-type': 'multipart/form-data; boundary=d5b7a1ccf3574e36bb83bdcaf5f32e6b'},
+            body=stream,
+        ))
+        bodies.append(request.body)
+    # Streamed and whole uploads share the cache, and come out the same.
+    assert bodies[0] == bodies[1] == bodies[2]
+    assert hashlib.md5(b'\xff' * 200).hexdigest().encode('ascii') in bodies[0]
+    assert cache.stats()['hits'] == 2
+
+
+def test_stream_not_multipart():
+    request = MockRequest(
+        method='POST',
+        url='https://graph.facebook.com/v2.4/me/photos',
+        headers={'content-type': 'multipart/form-data; boundary=abc'},
+        body=io.BytesIO(b'--abc\r\nnot really multipart'),
+    )
+    request = make_before_record(
+        elide_appsecret_proof=None,
+        elide_access_token=None,
+        elide_client_secret=None,
+        elider_prefix='XXX-',
+    )(request)
+    assert request.body == b'--abc\r\nnot really multipart'
+    # The header still matches the body.
+    assert request.headers['content-type'] == 'multipart/form-data; boundary=abc'
+
+
+@pytest.mark.parametrize('kind', ['file', 'iter'])
+def test_vcr_request_stream(kind):
+    # VCR.py's Request makes a new stream each time its body is read.
+    body = get_multipart_body(
+        boundary=b'd5b7a1ccf3574e36bb83bdcaf5f32e6b',
+        access_token=b'AAAAAAAAAAAAAAAAAAAAAAAAAAAA',
+        appsecret_proof=b'BBBBBBBBBBBBBBBBBBBBBBBBBBBB',
+        source=b'\xff' * 200,
+    )
+    before_record = make_before_record(
+        elide_appsecret_proof=None,
+        elide_access_token=None,
+        elide_client_secret=None,
+        elider_prefix='XXX-',
+        stream_chunk_size=16,
+    )
+    def make_request(body):
+        return Request(
+            'POST', 'https://graph.facebook.com/v2.4/me/photos',
+            io.BytesIO(body) if kind == 'file' else iter([body[:10], body[10:]]),
+            {'Content-Type': 'multipart/form-data; boundary=d5b7a1ccf3574e36bb83bdcaf5f32e6b'})
+
+    request = before_record(make_request(body))
+    assert request.headers['Content-Type'] == 'multipart/form-data; boundary=xxBOUNDARYxxBOUNDARYxxBOUNDARYxx'
+    new_body = request._body
+    assert new_body.startswith(b'--xxBOUNDARYxxBOUNDARYxxBOUNDARYxx\r\n')
+    assert b'd5b7a1ccf3574e36bb83bdcaf5f32e6b' not in new_body
+    assert b'AAAAAAAAAAAAAAAAAAAAAAAAAAAA' not in new_body
+    assert hashlib.md5(b'\xff' * 200).hexdigest().encode('ascii') in new_body
+
+    # A body that doesn't parse comes back unchanged, rather than raising.
+    request = before_record(make_request(b'--d5b7a1ccf3574e36bb83bdcaf5f32e6b\r\nnot really'))
+    assert request._body == b'--d5b7a1ccf3574e36bb83bdcaf5f32e6b\r\nnot really'
+
+
+def get_multipart_body(boundary, access_token, appsecret_proof, source):
+    return b''.join([
+        b'--', boundary, b'\r\n',
+        b'Content-Disposition: form-data; name="access_token"\r\n',
+        b'\r\n',
+        access_token, b'\r\n',
+        b'--', boundary, b'\r\n',
+        b'Content-Disposition: form-data; name="appsecret_proof"\r\n',
+        b'\r\n',
+        appsecret_proof, b'\r\n',
+        b'--', boundary, b'\r\n',
+        b'Content-Disposition: form-data; name="source"; filename="photo.jpg"\r\n',
+        b'Content-Type: image/jpeg\r\n',
+        b'\r\n',
+        source, b'\r\n',
+        b'--', boundary, b'--\r\n',
+    ])
+
+
+def test_upload_filter():
+    chunk = os.urandom(1000)
+    assert hash_upload(chunk, chunk_size=64) == hashlib.md5(chunk).hexdigest()
+    assert hash_upload(chunk, 'sha1') == hashlib.sha1(chunk).hexdigest()
+
+    cache = LRUCache(10)
+    upload_filter = make_upload_filter('sha1', cache)
+    for _ in range(3):
+        parts = MultiPartFormData(get_multipart_body(
+            boundary=b'd5b7a1ccf3574e36bb83bdcaf5f32e6b',
+            access_token=b'AAAAAAAAAAAAAAAAAAAAAAAAAAAA',
+            appsecret_proof=b'BBBBBBBBBBBBBBBBBBBBBBBBBBBB',
+            source=chunk,
+        ))
+        parts = upload_filter(parts)
+        assert parts['source'].content == hashlib.sha1(chunk).hexdigest().encode('ascii')
+    assert cache.stats()['hits'] == 2
+
+    # A CRC-32 collision isn't taken for the same content.
+    other = os.urandom(1000)
+    cache.get(('sha1', len(other), zlib.crc32(other) & 0xffffffff),
+              lambda: (chunk, 'not the digest'))
+    parts = upload_filter(MultiPartFormData(get_multipart_body(
+        boundary=b'd5b7a1ccf3574e36bb83bdcaf5f32e6b',
+        access_token=b'AAAAAAAAAAAAAAAAAAAAAAAAAAAA',
+        appsecret_proof=b'BBBBBBBBBBBBBBBBBBBBBBBBBBBB',
+        source=other,
+    )))
+    assert parts['source'].content == hashlib.sha1(other).hexdigest().encode('ascii')
+
+
+@pytest.mark.parametrize('algorithm', ['md5', 'sha512'])
+def test_upload_hash_idempotent(algorithm):
+    # Digests longer than the minimum upload size aren't hashed again.
+    before_record = make_before_record(
+        elide_appsecret_proof=None,
+        elide_access_token=None,
+        elide_client_secret=None,
+        elider_prefix='XXX-',
+        upload_hash=algorithm,
+    )
+    boundary = b'd5b7a1ccf3574e36bb83bdcaf5f32e6b'
+    request = MockRequest(
+        url='https://graph.facebook.com/v2.4/me/photos', method='POST',
+        headers={'Content-Type': 'multipart/form-data; boundary=' +
+                 boundary.decode('ascii')},
+        body=get_multipart_body(
+            boundary=boundary,
+            access_token=b'AAAAAAAAAAAAAAAAAAAAAAAAAAAA',
+            appsecret_proof=b'BBBBBBBBBBBBBBBBBBBBBBBBBBBB',
+            source=os.urandom(1000),
+        ),
+    )
+    body = before_record(request).body
+    assert before_record(request).body == body
+
+
+def test_before_record_stages():
+    before_record = make_before_record(
+        elide_appsecret_proof=None,
+        elide_access_token=None,
+        elide_client_secret=None,
+        elider_prefix='XXX-',
+    )
+    assert before_record.names == ('body', 'headers', 'url')
+
+    seen = []
+    extended = before_record.extend(('seen', lambda r: seen.append(r) or r))
+    assert len(extended) == len(before_record) + 1
+
+    request = MockRequest(url='https://example.com/?access_token=AAAA')
+    assert extended(request).uri == 'https://example.com/?access_token=AAAA'
+    assert seen == []
+
+
+def test_fast_path_counters():
+    before_record = make_before_record(
+        elide_appsecret_proof=None,
+        elide_access_token=None,
+        elide_client_secret=None,
+        elider_prefix='XXX-',
+    )
+    request = MockRequest(
+        method='POST',
+        url='https://graph.facebook.com/v2.4/me/feed',
+        headers={'content-type': 'application/x-www-form-urlencoded'},
+        body='message=hello+world',
+    )
+    request = before_record(request)
+    assert request.body == 'message=hello+world'
+    request = MockRequest(
+        url='https://graph.facebook.com/v2.4/me?access_token=AAAAAAAAAAAAAAAAAAAAAAAAAAAA',
+    )
+    request = before_record(request)
+    assert before_record.counters == {
+        'body.fast_path': 2,
+        'url.fast_path': 1,
+        'url.filtered': 1,
+    }
+
+
+def test_request_cache():
+    elide_access_token = Mock(return_value=None)
+    cache = LRUCache(10)
+    before_record = make_before_record(
+        elide_appsecret_proof=None,
+        elide_access_token=elide_access_token,
+        elide_client_secret=None,
+        elider_prefix='XXX-',
+        request_cache=cache,
+    )
+    headers = get_request_headers()
+    headers.update({
+        'content-type': 'multipart/form-data; boundary=d5b7a1ccf3574e36bb83bdcaf5f32e6b',
+        'content-length': '1000',
+    })
+    body = get_multipart_body(
+        boundary=b'd5b7a1ccf3574e36bb83bdcaf5f32e6b',
+        access_token=b'AAAAAAAAAAAAAAAAAAAAAAAAAAAA',
+        appsecret_proof=b'BBBBBBBBBBBBBBBBBBBBBBBBBBBB',
+        source=b'\xff' * 200,
+    )
+    first, second = [
+        before_record(MockRequest(
+            method='POST',
+            url='https://graph.facebook.com/v2.4/me/photos?access_token=AAAAAAAAAAAAAAAAAAAAAAAAAAAA',
+            headers=dict(headers),
+            body=body,
+        ))
+        for _ in range(2)
+    ]
+    assert vars(second) == vars(first)
+    assert 'content-length' not in second.headers
+    assert second.headers['content-type'] == 'multipart/form-data; boundary=xxBOUNDARYxxBOUNDARYxxBOUNDARYxx'
+    # Once in the url and once in the body of the first request only.
+    assert elide_access_token.call_count == 2
+    assert cache.stats()['hits'] == 1
+
+    # The cached pipeline has the same interface as the plain one.
+    assert before_record.names == ('body', 'headers', 'url')
+    extended = before_record.extend(('seen', lambda r: r))
+    assert extended.names == ('body', 'headers', 'url', 'seen')
+    assert extended.cache is not cache
+
+    # A header removed from the first request needn't be in the next.
+    for content_length in ['0', None]:
+        headers = {'content-length': content_length} if content_length else {}
+        request = before_record(MockRequest(
+            url='https://graph.facebook.com/v2.4/me?access_token=AAAAAAAAAAAAAAAAAAAAAAAAAAAA',
+            headers=headers,
+        ))
+        assert 'content-length' not in request.headers
+
+    # These bodies have the same length and CRC-32.
+    for message in ['plumless', 'buckeroo']:
+        request = before_record(MockRequest(
+            method='POST',
+            url='https://graph.facebook.com/v2.4/me/feed',
+            headers={'content-type': 'application/x-www-form-urlencoded'},
+            body='message={0}&access_token=AAAAAAAAAAAAAAAAAAAAAAAAAAAA'
+                 .format(message).encode('ascii'),
+        ))
+        assert request.body.startswith('message={0}&'.format(message)
+                                       .encode('ascii'))
+
+
 def _test_request(request, new_request, **kwargs):
     defaults = dict(
         elide_appsecret_proof=None,
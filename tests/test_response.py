@@ -3,9 +3,12 @@ from __future__ import absolute_import, unicode_literals, print_function
 import copy
 import json
 import os
+import zlib
 from mock import MagicMock as Mock
 
-from vcr_facebook.response import make_before_record_response
+from vcr_facebook.cache import LRUCache
+from vcr_facebook.response import (AccessTokenStream, make_access_token_replace,
+                                   make_before_record_response, sub_access_tokens)
 
 
 def test_simple_response():
@@ -26,6 +29,139 @@ def test_batch_response():
                    new_batch_response_data())
 
 
+def test_batch_response_escaped():
+    data = get_batch_response_data()
+    for item in data:
+        if item['body'] is not None:
+            item['body'] = json.dumps(item['body'], sort_keys=True,
+                                      separators=',:')
+    response = mock_response(headers=get_response_headers(), data=data)
+    before_record_response = make_before_record_response(
+        elide_access_token=None,
+        elider_prefix='XXX-',
+    )
+    response = before_record_response(response)
+
+    data = json.loads(response['body']['string'].decode('utf-8'))
+    for item in data:
+        if item['body'] is not None:
+            item['body'] = json.loads(item['body'])
+    assert data == new_batch_response_data()
+
+
+def test_response_body_unchanged():
+    before_record_response = make_before_record_response(
+        elide_access_token=None,
+        elider_prefix='XXX-',
+    )
+    for body in [b'{"id":"1"}',
+                 b'{"access_token":"XXX-08ad1422b56189a907f77ee2c7f3ea24"}']:
+        response = mock_response(headers=get_response_headers(), data=None)
+        response['body']['string'] = body
+        new_response = before_record_response(response)
+        assert new_response['body']['string'] is body
+
+
+def test_response_not_utf8():
+    response = mock_response(headers=get_response_headers(), data=None)
+    response['body']['string'] = (b'\xff\xfe"access_token":"AAAAAAAAAAAAAAAAAAAAAAAAAAAA"')
+    before_record_response = make_before_record_response(
+        elide_access_token=None,
+        elider_prefix='XXX-',
+    )
+    response = before_record_response(response)
+    assert response['body']['string'] == (
+        b'\xff\xfe"access_token":"XXX-35ea99843da5ff0639992be381c5b77a"')
+
+
+def test_response_skipped():
+    before_record_response = make_before_record_response(
+        elide_access_token=None,
+        elider_prefix='XXX-',
+        max_scan_size=1000,
+    )
+
+    headers = get_response_headers()
+    headers['content-type'] = ['image/jpeg']
+    response = mock_response(headers=headers, data=None)
+    response['body']['string'] = b'\xff\xd8access_token=AAAA'
+    assert before_record_response(response) is response
+
+    response = mock_response(headers=get_response_headers(),
+                             data=get_paged_response_data())
+    assert before_record_response(response) is response
+
+    response = mock_response(headers=get_response_headers(),
+                             data=get_simple_response_data())
+    assert before_record_response(response) is not response
+
+    assert before_record_response.counters == {
+        'response.skipped_content_type': 1,
+        'response.skipped_size': 1,
+        'response.scanned': 1,
+    }
+
+
+def test_access_token_stream():
+    replace = make_access_token_replace(None, 'XXX-')
+    data = get_batch_response_data()
+    data[2]['body'] = json.dumps(data[2]['body'])
+    body = json.dumps(data).encode('utf-8')
+    expected = sub_access_tokens(replace, body)
+    assert expected != body
+
+    for chunk_size in [1, 7, 100, 4096]:
+        stream = AccessTokenStream(replace, window=512)
+        for i in range(0, len(body), chunk_size):
+            stream.feed(body[i:i + chunk_size])
+        assert stream.close() == expected
+        assert stream.changed
+
+
+def test_response_elision_cache():
+    elide_access_token = Mock(return_value='TOKEN')
+    cache = LRUCache(10)
+    before_record_response = make_before_record_response(
+        elide_access_token=elide_access_token,
+        elider_prefix='XXX-',
+        elision_cache=cache,
+    )
+    for _ in range(2):
+        before_record_response(mock_response(headers=get_response_headers(),
+                                             data=get_paged_response_data()))
+    # Five distinct tokens, each elided once.
+    assert elide_access_token.call_count == 5
+    assert cache.stats()['misses'] == 5
+    assert cache.stats()['hits'] == 5
+
+
+def test_response_not_modified_streaming():
+    test_response_not_modified(gzip_chunk_size=64)
+
+
+def test_response_not_modified(**kwargs):
+    headers = get_response_headers()
+    headers['content-encoding'] = ['gzip']
+    response = mock_response(headers=headers, data=get_paged_response_data())
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    response['body']['string'] = (compressor.compress(response['body']['string']) +
+                                  compressor.flush())
+    original = copy.deepcopy(response)
+
+    before_record_response = make_before_record_response(
+        elide_access_token=None,
+        elider_prefix='XXX-',
+        **kwargs
+    )
+    new_response = before_record_response(response)
+
+    # The application still sees the original response.
+    assert response == original
+    assert 'content-encoding' not in new_response['headers']
+    data = json.loads(new_response['body']['string'].decode('utf-8'))
+    assert data == new_paged_response_data()
+
+
 def _test_response(headers, data, new_data, **kwargs):
     check_headers = copy.deepcopy(headers)
     response = mock_response(headers=headers, data=data)
@@ -0,0 +1,60 @@
+from __future__ import absolute_import, unicode_literals, print_function
+
+import io
+
+import vcr_facebook
+from vcr_facebook.stats import Stats
+
+from .test_request import MockRequest
+from .test_response import (get_paged_response_data, get_response_headers,
+                            mock_response)
+
+
+def test_stats():
+    kwargs, stats = vcr_facebook.get_vcr_kwargs_with_stats()
+    assert isinstance(stats, Stats)
+    before_record = kwargs['before_record']
+    before_record_response = kwargs['before_record_response']
+
+    before_record(MockRequest(
+        url='https://graph.facebook.com/v2.4/me?access_token=AAAAAAAAAAAAAAAAAAAAAAAAAAAA',
+    ))
+    before_record(MockRequest(
+        method='POST',
+        url='https://graph.facebook.com/v2.4/me/feed',
+        headers={'content-type': 'text/plain'},
+        body='access_token',
+    ))
+    before_record(MockRequest(url='https://example.com/'))
+    before_record_response(mock_response(headers=get_response_headers(),
+                                         data=get_paged_response_data()))
+
+    assert stats.counters == {
+        'body.fast_path': 1,
+        'body.filtered': 1,
+        'body.unparsed': 1,
+        'url.fast_path': 1,
+        'url.filtered': 1,
+        'elided.access_token': 6,  # one in the url, five in the response
+        'request.skipped': 1,
+        'response.scanned': 1,
+    }
+
+    timings = stats.timings()
+    assert list(timings) == [
+        'request.body', 'request.headers', 'request.url',
+        'response.copy', 'response.ungzip',
+        'response.access_tokens', 'response.content_length']
+    assert timings['request.body']['calls'] == 2
+    assert timings['request.body']['bytes_in'] == len('access_token')
+    body = timings['response.access_tokens']
+    assert body['calls'] == 1
+    assert body['bytes_in'] > body['bytes_out'] > 0
+
+    out = io.StringIO()
+    stats.dump(out)
+    assert 'response.access_tokens' in out.getvalue()
+    assert 'elided.access_token' in out.getvalue()
+
+    stats.reset()
+    assert stats.summary() == dict(counters={}, timings={})
@@ -1,7 +1,14 @@
 from __future__ import absolute_import, unicode_literals, print_function
 
+from .cache import LRUCache
+from . import deferred as _deferred
+from .deferred import register_persister
+from .fields import (BODY, RESPONSE, SCOPES, URL, FieldRegistry,
+                     SensitiveField, default_fields)
+from .matchers import register_matcher
 from .request import wrap_before_record
 from .response import wrap_before_record_response
+from .stats import Stats
 from .util import identity
 
 
@@ -9,32 +16,92 @@ def get_vcr_kwargs(vcr_kwargs=None,
                    elide_appsecret_proof=None,
                    elide_access_token=None,
                    elide_client_secret=None,
-                   elider_prefix='XXX-'):
+                   elider_prefix='XXX-',
+                   max_response_scan_size=None,
+                   gzip_chunk_size=None,
+                   elision_cache_size=None,
+                   elision_cache=None,
+                   upload_hash='md5',
+                   upload_cache_size=None,
+                   fields=None,
+                   stats=None,
+                   request_cache_size=None,
+                   deferred=None,
+                   deferred_workers=None):
 
     if vcr_kwargs is None:
         vcr_kwargs = {}
 
+    if elision_cache is None and elision_cache_size:
+        elision_cache = LRUCache(elision_cache_size)
+
+    if fields is None:
+        fields = default_fields(
+            elide_appsecret_proof=elide_appsecret_proof,
+            elide_access_token=elide_access_token,
+            elide_client_secret=elide_client_secret,
+        )
+    matcher = fields.compile(elider_prefix, elision_cache,
+                             stats and stats.counters)
+
     make_before_record_kwargs = dict(
         elide_appsecret_proof=elide_appsecret_proof,
         elide_access_token=elide_access_token,
         elide_client_secret=elide_client_secret,
         elider_prefix=elider_prefix,
+        elision_cache=elision_cache,
+        upload_hash=upload_hash,
+        upload_cache=LRUCache(upload_cache_size) if upload_cache_size else None,
+        fields=matcher,
+        stats=stats,
+        request_cache=(LRUCache(request_cache_size) if request_cache_size
+                       else None),
     )
 
     make_before_record_response_kwargs = dict(
         elide_access_token=elide_access_token,
         elider_prefix=elider_prefix,
+        max_scan_size=max_response_scan_size,
+        gzip_chunk_size=gzip_chunk_size,
+        elision_cache=elision_cache,
+        fields=matcher,
+        stats=stats,
     )
 
+    if deferred:
+        sanitizer = _deferred.DeferredSanitizer(
+            make_before_record_response_kwargs,
+            executor='thread' if deferred is True else deferred,
+            max_workers=deferred_workers,
+            spec=(fields, elider_prefix, max_response_scan_size,
+                  gzip_chunk_size),
+        )
+        before_record_response = _deferred.wrap_before_record_response(
+            vcr_kwargs.get('before_record_response', identity), sanitizer)
+    else:
+        before_record_response = wrap_before_record_response(
+            vcr_kwargs.get('before_record_response', identity),
+            **make_before_record_response_kwargs)
+
     return dict(
         vcr_kwargs,
         before_record=wrap_before_record(
             vcr_kwargs.get('before_record', identity),
             **make_before_record_kwargs),
-        before_record_response=wrap_before_record_response(
-            vcr_kwargs.get('before_record_response', identity),
-            **make_before_record_response_kwargs),
+        before_record_response=before_record_response,
     )
 
 
-__all__ = ['get_vcr_kwargs']
+def get_vcr_kwargs_with_stats(*args, **kwargs):
+    """
+    Like get_vcr_kwargs, but instrument the hooks and return (kwargs, stats)
+    where stats is a Stats collecting per-stage timing and counters.
+    """
+    stats = kwargs.pop('stats', None) or Stats()
+    return get_vcr_kwargs(*args, stats=stats, **kwargs), stats
+
+
+__all__ = ['BODY', 'FieldRegistry', 'LRUCache', 'RESPONSE', 'SCOPES',
+           'SensitiveField', 'Stats', 'URL', 'default_fields',
+           'get_vcr_kwargs', 'get_vcr_kwargs_with_stats', 'register_matcher',
+           'register_persister']
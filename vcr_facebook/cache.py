@@ -0,0 +1,73 @@
+from __future__ import absolute_import, unicode_literals, print_function
+
+import threading
+
+from .compat import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Bounded, thread-safe least-recently-used cache.
+
+    This is used to memoize elisions, keyed by (field, original value), so
+    that an elide_* callback runs once per distinct token rather than once
+    per occurrence.
+
+    The value is computed outside the lock, so a slow callback doesn't block
+    other threads. Two threads missing on the same key at the same time might
+    both compute it, which is harmless for elision.
+    """
+
+    def __init__(self, maxsize=1024):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """
+        Return the cached value for key, calling compute() to fill it in on
+        a miss.
+        """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data[key] = value
+                return value
+
+        value = compute()
+
+        with self._lock:
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                size=len(self._data),
+                maxsize=self.maxsize,
+            )
+
+    def __repr__(self):
+        return '<{0} {1}>'.format(type(self).__name__, self.stats())
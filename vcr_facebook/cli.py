@@ -0,0 +1,274 @@
+"""
+Sanitize cassettes that were recorded without vcr_facebook, or with older
+rules, by passing every interaction in them through the same hooks that
+get_vcr_kwargs makes.
+
+    vcr-facebook-sanitize [--check] [--jobs N] [--fields MODULE:ATTR] PATH...
+
+Directories are searched for .yaml, .yml and .json cassettes. Files are
+sanitized in parallel on a process pool, and each one is replaced atomically
+only if it changed.
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+
+import argparse
+import collections
+import copy
+import importlib
+import io
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+from timeit import default_timer
+
+try:
+    from concurrent import futures
+except ImportError:
+    # python 2 without the futures backport
+    futures = None
+
+from vcr.serialize import deserialize, serialize
+from vcr.serializers import jsonserializer, yamlserializer
+
+from .fields import FieldRegistry, default_fields
+from .request import make_before_record
+from .response import make_before_record_response
+
+
+EXTENSIONS = ('.yaml', '.yml', '.json')
+
+replace = getattr(os, 'replace', os.rename)
+
+
+def load_fields(name):
+    """
+    Import the FieldRegistry named by 'module:attr', from the current
+    directory if need be. attr may also name a function that returns one.
+    """
+    module_name, _, attr = name.partition(':')
+    if not module_name or not attr:
+        raise ValueError("Expected module:attr, not {0!r}".format(name))
+    if os.getcwd() not in sys.path and '' not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    fields = importlib.import_module(module_name)
+    for part in attr.split('.'):
+        fields = getattr(fields, part)
+    if not isinstance(fields, FieldRegistry):
+        fields = fields()
+    if not isinstance(fields, FieldRegistry):
+        raise TypeError("{0} isn't a FieldRegistry".format(name))
+    return fields
+
+
+def make_pipelines(spec, counters):
+    """
+    Make (before_record, before_record_response) from spec, which is
+    (fields, elider_prefix, max_scan_size, gzip_chunk_size, upload_hash)
+    where fields is a FieldRegistry, or a name for load_fields so that each
+    worker imports it rather than it being pickled. Elisions are counted in
+    counters.
+    """
+    fields, elider_prefix, max_scan_size, gzip_chunk_size, upload_hash = spec
+    if not isinstance(fields, FieldRegistry):
+        fields = load_fields(fields)
+    matcher = fields.compile(elider_prefix, None, counters)
+    before_record = make_before_record(
+        elide_appsecret_proof=None,
+        elide_access_token=None,
+        elide_client_secret=None,
+        elider_prefix=elider_prefix,
+        upload_hash=upload_hash,
+        fields=matcher,
+    )
+    before_record_response = make_before_record_response(
+        elide_access_token=None,
+        elider_prefix=elider_prefix,
+        max_scan_size=max_scan_size,
+        gzip_chunk_size=gzip_chunk_size,
+        fields=matcher,
+    )
+    return before_record, before_record_response
+
+
+def get_serializer(path):
+    if path.endswith('.json'):
+        return jsonserializer
+    return yamlserializer
+
+
+def sanitize_file(path, spec, write=True):
+    """
+    Sanitize the cassette at path. Returns a dict of path, interactions,
+    seconds, changed, counters and error (a message, or None). The file is
+    only written if it changed and write is true.
+    """
+    result = dict(path=path, interactions=0, seconds=0.0, changed=False,
+                  counters={}, error=None)
+    start = default_timer()
+    try:
+        serializer = get_serializer(path)
+        with io.open(path, 'rb') as f:
+            requests, responses = deserialize(f.read().decode('utf-8'),
+                                              serializer)
+        # Bodies are immutable, so this only copies the structure. VCR.py's
+        # serialize converts responses in place, so it can't be used here.
+        original = copy.deepcopy(interactions(requests, responses))
+
+        counters = collections.Counter()
+        before_record, before_record_response = make_pipelines(spec, counters)
+        cassette_dict = dict(requests=[], responses=[])
+        for request, response in zip(requests, responses):
+            request = before_record(request)
+            response = before_record_response(response)
+            # Like VCR.py, drop interactions the hooks filter out.
+            if request is not None and response is not None:
+                cassette_dict['requests'].append(request)
+                cassette_dict['responses'].append(response)
+        changed = interactions(**cassette_dict) != original
+
+        result.update(interactions=len(requests), changed=changed,
+                      counters=dict(counters))
+        if write and changed:
+            write_atomic(path, serialize(cassette_dict, serializer))
+    except Exception as e:
+        result['error'] = '{0}: {1}'.format(type(e).__name__, e)
+    result['seconds'] = default_timer() - start
+    return result
+
+
+def interactions(requests, responses):
+    return [(request._to_dict(), response)
+            for request, response in zip(requests, responses)]
+
+
+def write_atomic(path, data):
+    """
+    Replace the file at path with data, keeping its mode, by way of a
+    temporary file in the same directory.
+    """
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp',
+                               dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        shutil.copymode(path, tmp)
+        replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def find_cassettes(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith(EXTENSIONS):
+                    yield os.path.join(root, name)
+
+
+def sanitize_files(paths, spec, write=True, jobs=None):
+    """
+    Yield the result of sanitize_file for each of paths, in order. With more
+    than one job the files are sanitized on a process pool.
+    """
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if jobs <= 1 or len(paths) <= 1 or futures is None:
+        for path in paths:
+            yield sanitize_file(path, spec, write)
+        return
+    pool = futures.ProcessPoolExecutor(min(jobs, len(paths)))
+    try:
+        results = [pool.submit(sanitize_file, path, spec, write)
+                   for path in paths]
+        for job in results:
+            yield job.result()
+    finally:
+        pool.shutdown()
+
+
+def format_result(result, write=True):
+    if result['error']:
+        status = 'error'
+    elif result['changed']:
+        status = 'sanitized' if write else 'would sanitize'
+    else:
+        status = 'unchanged'
+    line = '{0}: {1}, {2} interactions, {3:.1f}ms'.format(
+        result['path'], status, result['interactions'],
+        result['seconds'] * 1000)
+    elided = sorted((k, v) for k, v in result['counters'].items()
+                    if k.startswith('elided.'))
+    if elided:
+        line += ', ' + ', '.join('{0}={1}'.format(k, v) for k, v in elided)
+    if result['error']:
+        line += ', ' + result['error']
+    return line
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0])
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+                        help='cassette files or directories')
+    parser.add_argument('--check', action='store_true',
+                        help="don't write anything, and exit 1 if any "
+                             "cassette would change")
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='number of processes (default: one per CPU)')
+    parser.add_argument('--fields', metavar='MODULE:ATTR',
+                        help="the project's FieldRegistry, with its elide "
+                             "callbacks (default: the default fields)")
+    parser.add_argument('--prefix', default='XXX-',
+                        help='elider prefix (default: %(default)s)')
+    parser.add_argument('--max-response-scan-size', type=int)
+    parser.add_argument('--gzip-chunk-size', type=int)
+    parser.add_argument('--upload-hash', default='md5')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='only report cassettes that change or fail')
+    args = parser.parse_args(argv)
+
+    fields = default_fields()
+    if args.fields:
+        # Fail now rather than once for every cassette.
+        try:
+            load_fields(args.fields)
+        except Exception as e:
+            parser.error('--fields: {0}: {1}'.format(type(e).__name__, e))
+        fields = args.fields
+
+    spec = (fields, args.prefix, args.max_response_scan_size,
+            args.gzip_chunk_size, args.upload_hash)
+    write = not args.check
+    paths = list(find_cassettes(args.paths))
+
+    start = default_timer()
+    totals = collections.Counter()
+    errors = changed = 0
+    for result in sanitize_files(paths, spec, write, args.jobs):
+        errors += bool(result['error'])
+        changed += result['changed']
+        totals.update(result['counters'])
+        if not args.quiet or result['changed'] or result['error']:
+            print(format_result(result, write))
+
+    print('{0} cassettes, {1} {2}, {3} errors in {4:.1f}s'.format(
+        len(paths), changed, 'sanitized' if write else 'would change',
+        errors, default_timer() - start), file=sys.stderr)
+    for name, count in sorted(totals.items()):
+        if name.startswith('elided.'):
+            print('  {0} {1}'.format(name, count), file=sys.stderr)
+
+    return 1 if errors or (args.check and changed) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,10 +6,29 @@ except ImportError:
     # python 2.6
     from ordereddict import OrderedDict
 
+try:
+    # python 3.3+
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
 try:
     # python 3
-    from urllib.parse import parse_qsl, quote
+    from urllib.parse import parse_qsl, quote, unquote_plus, urlsplit
 except ImportError:
     # python 2
-    from urllib import quote
-    from urlparse import parse_qsl
+    from urllib import quote, unquote_plus
+    from urlparse import parse_qsl, urlsplit
+
+try:
+    text_type = unicode
+except NameError:
+    # python 3
+    text_type = str
+
+if bytes is str:
+    # python 2: str.join can't take memoryview, so slices are plain copies
+    def byte_view(b):
+        return b
+else:
+    byte_view = memoryview
@@ -0,0 +1,177 @@
+from __future__ import absolute_import, unicode_literals, print_function
+
+import pickle
+import threading
+
+try:
+    from concurrent import futures
+except ImportError:
+    # python 2 without the futures backport
+    futures = None
+
+from .response import make_before_record_response
+
+
+class DeferredSanitizer(object):
+    """
+    Sanitize recorded responses when the cassette is saved, rather than as
+    each one is recorded.
+
+    register_persister() wraps a VCR's persister in a DeferredPersister and
+    has that VCR pass responses through untouched, so nothing is scanned
+    while the test runs. When the DeferredPersister saves a cassette, its
+    responses are passed through the response pipeline in chunks on a
+    concurrent.futures pool, and updated in place. The pipeline leaves
+    elided values alone, so responses that were already sanitized come out
+    the same. Nothing is kept between saves, so a cassette that is only
+    replayed costs nothing.
+
+    Any other VCR made from the same kwargs still sanitizes each response as
+    it's recorded, so that nothing is written unsanitized by a VCR without a
+    DeferredPersister.
+
+    With executor='thread' the pipeline is the one from
+    make_before_record_response(**response_kwargs). With executor='process'
+    each worker makes its own pipeline with make_process_pipeline(spec), so
+    spec and the responses have to be picklable (along with the elide
+    callbacks in it). spec is checked up front, so that a callback that can't
+    be pickled fails here rather than when the first cassette is saved.
+
+    Requests are still sanitized as they're made, since VCR.py matches live
+    requests against the cassette with the output of before_record.
+    """
+
+    def __init__(self, response_kwargs=None, executor='thread',
+                 max_workers=None, chunk_size=8, spec=None):
+        if futures is None:
+            raise ImportError("Deferred sanitization needs concurrent.futures "
+                              "(pip install futures on Python 2)")
+        if executor not in ('thread', 'process'):
+            raise ValueError("executor must be 'thread' or 'process'")
+        if executor == 'process' and spec is None:
+            raise ValueError("executor='process' needs a picklable spec")
+        if executor == 'thread' and response_kwargs is None:
+            raise ValueError("executor='thread' needs response_kwargs")
+        if executor == 'process':
+            try:
+                pickle.dumps(spec, pickle.HIGHEST_PROTOCOL)
+            except (pickle.PicklingError, TypeError, AttributeError) as e:
+                raise ValueError("executor='process' needs a picklable spec "
+                                 "({0})".format(e))
+        self.executor = executor
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.spec = spec
+        self.response_kwargs = response_kwargs
+        self._pipeline = None
+        self._lock = threading.Lock()
+
+    @property
+    def pipeline(self):
+        with self._lock:
+            if self._pipeline is None:
+                if self.response_kwargs is not None:
+                    self._pipeline = make_before_record_response(
+                        **self.response_kwargs)
+                else:
+                    self._pipeline = make_process_pipeline(self.spec)
+            return self._pipeline
+
+    def sanitize(self, responses):
+        """
+        Sanitize responses in place.
+        """
+        todo = [r for r in responses if r is not None]
+        if not todo:
+            return
+        chunks = [todo[i:i + self.chunk_size]
+                  for i in range(0, len(todo), self.chunk_size)]
+
+        if self.executor == 'thread':
+            pool = futures.ThreadPoolExecutor(self.max_workers or 4)
+            jobs = [pool.submit(_sanitize_chunk, self.pipeline, chunk)
+                    for chunk in chunks]
+        else:
+            pool = futures.ProcessPoolExecutor(self.max_workers)
+            jobs = [pool.submit(_sanitize_chunk_in_process, self.spec, chunk)
+                    for chunk in chunks]
+        try:
+            for chunk, job in zip(chunks, jobs):
+                for response, new in zip(chunk, job.result()):
+                    if new is not response:
+                        response.clear()
+                        response.update(new)
+        finally:
+            pool.shutdown()
+
+    def persister(self, persister):
+        return DeferredPersister(persister, self)
+
+
+class DeferredPersister(object):
+    """
+    Wrap a VCR.py persister to run DeferredSanitizer.sanitize on the
+    responses of a cassette before saving it.
+    """
+
+    def __init__(self, persister, sanitizer):
+        self.persister = persister
+        self.sanitizer = sanitizer
+
+    def load_cassette(self, cassette_path, serializer):
+        return self.persister.load_cassette(cassette_path, serializer)
+
+    def save_cassette(self, cassette_path, cassette_dict, serializer):
+        self.sanitizer.sanitize(cassette_dict['responses'])
+        return self.persister.save_cassette(cassette_path, cassette_dict,
+                                            serializer)
+
+
+def _sanitize_chunk(pipeline, responses):
+    return [pipeline(r) for r in responses]
+
+
+def make_process_pipeline(spec):
+    """
+    Make a response pipeline from spec, which is (fields, elider_prefix,
+    max_scan_size, gzip_chunk_size) where fields is a FieldRegistry.
+    """
+    fields, elider_prefix, max_scan_size, gzip_chunk_size = spec
+    return make_before_record_response(
+        elide_access_token=None,
+        elider_prefix=elider_prefix,
+        max_scan_size=max_scan_size,
+        gzip_chunk_size=gzip_chunk_size,
+        fields=fields.compile(elider_prefix),
+    )
+
+
+def _sanitize_chunk_in_process(spec, responses):
+    return _sanitize_chunk(make_process_pipeline(spec), responses)
+
+
+def wrap_before_record_response(wrapped, sanitizer):
+    # This is the hook for a VCR without a DeferredPersister, so it sanitizes
+    # as usual. register_persister swaps in wrapped for the VCR it's given.
+    def wrapper(response):
+        response = wrapped(response)
+        if response is not None:
+            response = sanitizer.pipeline(response)
+        return response
+    wrapper.deferred = sanitizer
+    wrapper.wrapped = wrapped
+    return wrapper
+
+
+def register_persister(my_vcr, kwargs):
+    """
+    Register a DeferredPersister on a VCR instance made with kwargs from
+    get_vcr_kwargs(deferred=...), and have that VCR leave responses to it.
+    Other VCRs made from the same kwargs keep sanitizing as they record.
+    Returns the persister.
+    """
+    hook = kwargs['before_record_response']
+    persister = hook.deferred.persister(my_vcr.persister)
+    my_vcr.register_persister(persister)
+    my_vcr.before_record_response = hook.wrapped
+    return persister
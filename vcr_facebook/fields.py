@@ -0,0 +1,172 @@
+from __future__ import absolute_import, unicode_literals, print_function
+
+from collections import namedtuple
+import re
+
+from .compat import OrderedDict
+from .filters import chain_filters, make_elider_filter
+
+
+# Where a sensitive field is looked for: request urls, request bodies (form,
+# multipart and batch) and response bodies.
+URL = 'url'
+BODY = 'body'
+RESPONSE = 'response'
+SCOPES = (URL, BODY, RESPONSE)
+
+
+class SensitiveField(namedtuple('SensitiveField', 'name elide requires scopes')):
+    """
+    A parameter to elide wherever it appears in scopes.
+
+    elide is called with the value, followed by the values of the fields named
+    in requires (None where they're missing), and returns the elided value.
+    If elide is None or returns something falsy, the md5 hex digest is used.
+    """
+    __slots__ = ()
+
+
+class FieldRegistry(object):
+    """
+    Ordered collection of SensitiveFields, keyed by name.
+
+    Order matters where one field requires another: the field that requires
+    should come first, so that it's elided while the field it requires still
+    has its original value.
+    """
+
+    def __init__(self, fields=()):
+        self._fields = OrderedDict((f.name, f) for f in fields)
+
+    def add(self, name, elide=None, requires=(), scopes=(URL, BODY)):
+        """
+        Add a field, or replace the field with the same name in place.
+        Returns the SensitiveField.
+        """
+        for scope in scopes:
+            if scope not in SCOPES:
+                raise ValueError("Unknown scope: {0!r}".format(scope))
+        field = SensitiveField(name, elide, tuple(requires), tuple(scopes))
+        self._fields[name] = field
+        return field
+
+    def remove(self, name):
+        del self._fields[name]
+
+    def copy(self):
+        return type(self)(self)
+
+    def compile(self, prefix, cache=None, counters=None):
+        return FieldMatcher(self, prefix, cache, counters)
+
+    def __getitem__(self, name):
+        return self._fields[name]
+
+    def __contains__(self, name):
+        return name in self._fields
+
+    def __iter__(self):
+        return iter(self._fields.values())
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __repr__(self):
+        return '<{0} {1}>'.format(type(self).__name__, list(self._fields))
+
+
+def default_fields(elide_appsecret_proof=None,
+                   elide_access_token=None,
+                   elide_client_secret=None):
+    """
+    Return a FieldRegistry of the fields that are elided out of the box.
+    """
+    fields = FieldRegistry()
+    fields.add('appsecret_proof', elide_appsecret_proof,
+               requires=['access_token'])
+    fields.add('access_token', elide_access_token, scopes=SCOPES)
+    fields.add('input_token', elide_access_token)
+    fields.add('client_secret', elide_client_secret)
+    return fields
+
+
+def compile_token_re(names):
+    """
+    Compile a bytes pattern for the named tokens in a response body, in either
+    of the two forms they take:
+
+      "name":"..."  in JSON, with any level of escaping for nested JSON
+      name=...      in paging URLs
+
+    The groups are (prefix, quotes, name, value) for the first form and
+    (prefix, name, value) for the second.
+    """
+    names = b'|'.join(re.escape(n.encode('ascii')) for n in names)
+    return re.compile(
+        br'((\\*")(' + names + br')\2:\s*\2)([^\\"]+)\2'
+        br'|((' + names + br')=)([^\\&"]+)'
+    )
+
+
+class FieldMatcher(object):
+    """
+    A FieldRegistry compiled for a given elider prefix and cache (see
+    cache.LRUCache), shared by the request and response filters.
+
+    filter(scope) is a single filter over parsed query or multipart data that
+    elides every field in the scope. markers(scope) are the field names, for
+    make_prescan_filter. For responses, token_keys and token_re are the field
+    names as bytes and the pattern compiled from them, and token_elides maps
+    each name to its elide callback.
+
+    If counters is given then "elided.<name>" is incremented for each value
+    elided, in any scope.
+    """
+
+    def __init__(self, fields, prefix, cache=None, counters=None):
+        self.fields = list(fields)
+        self.prefix = prefix
+        self.cache = cache
+        self.counters = counters
+        self._filters = dict(
+            (scope, chain_filters([
+                make_elider_filter(f.name, _data_elider(f), prefix, cache,
+                                   counters)
+                for f in self.fields if scope in f.scopes
+            ]))
+            for scope in (URL, BODY)
+        )
+        names = self.markers(RESPONSE)
+        self.token_keys = tuple(n.encode('ascii') for n in names)
+        self.token_re = compile_token_re(names) if names else None
+        self.token_elides = dict(
+            (f.name.encode('ascii'), _value_elider(f))
+            for f in self.fields if RESPONSE in f.scopes
+        )
+
+    def filter(self, scope):
+        return self._filters[scope]
+
+    def markers(self, scope):
+        return tuple(f.name for f in self.fields if scope in f.scopes)
+
+
+def _data_elider(field):
+    if not field.elide:
+        return None
+    def elide(data):
+        return field.elide(data[field.name],
+                           *[data.get(r) for r in field.requires])
+    return elide
+
+
+def _value_elider(field):
+    # Responses are scanned for tokens in isolation, so there are no values
+    # for the fields this one requires.
+    if not field.elide:
+        return None
+    if not field.requires:
+        return field.elide
+    def elide(value):
+        return field.elide(value, *[None for r in field.requires])
+    return elide
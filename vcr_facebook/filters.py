@@ -1,6 +1,5 @@
 from __future__ import absolute_import, unicode_literals, print_function
 
-from collections import MutableMapping
 from functools import wraps
 import hashlib
 import json
@@ -8,7 +7,7 @@ import logging
 import re
 import zlib
 
-from .compat import OrderedDict, parse_qsl, quote
+from .compat import MutableMapping, OrderedDict, quote, unquote_plus
 from . import multipart
 
 
@@ -16,8 +15,17 @@ logger = logging.getLogger(__name__)
 
 
 class BaseParser(MutableMapping):
+    """
+    Mapping view of some raw data, which serializes back to the raw form.
+
+    Setting or deleting an item marks the parser dirty. Until then,
+    serialize() returns the original raw object rather than rebuilding it.
+    Code that modifies the parsed data some other way (for example the
+    requests in a batch) should set dirty itself.
+    """
 
     def __init__(self, raw, ignore_exceptions=True):
+        self.dirty = False
         self.raw = raw
         self.ignore_exceptions = ignore_exceptions
         try:
@@ -28,11 +36,22 @@ class BaseParser(MutableMapping):
             else:
                 raise
 
-    def __str__(self):
+    def serialize(self):
+        """
+        Return the (possibly modified) data in its raw form. This is the same
+        as str() except for parsers of bytes on python 3, such as
+        MultipartParser.
+        """
         return (self._unparse(self.parsed, self.raw)
-                if self.parsed is not None else
+                if self.parsed is not None and self.is_dirty() else
                 self.raw)
 
+    def is_dirty(self):
+        return self.dirty
+
+    def __str__(self):
+        return self.serialize()
+
     def _parse(self, raw):
         raise NotImplementedError
 
@@ -45,10 +64,14 @@ class BaseParser(MutableMapping):
         return self.parsed[key]
 
     def __setitem__(self, key, value):
+        if key in self.parsed and self.parsed[key] == value:
+            return
         self.parsed[key] = value
+        self.dirty = True
 
     def __delitem__(self, key):
         del self.parsed[key]
+        self.dirty = True
 
     def __iter__(self):
         return iter(self.parsed or [])
@@ -59,6 +82,8 @@ class BaseParser(MutableMapping):
     def __nonzero__(self):
         return bool(self.parsed)
 
+    __bool__ = __nonzero__
+
     def __getattr__(self, key):
         return getattr(self.parsed, key)
 
@@ -72,15 +97,75 @@ class BaseParser(MutableMapping):
 
 
 class QueryParser(BaseParser):
+    """
+    Mapping of a query string's keys to values, which remembers where each
+    value came from. Serializing splices in only the values that changed,
+    so everything else stays byte-for-byte identical and the cost depends on
+    the number of changes rather than the length of the query.
+
+    Bytes are parsed as latin-1 (query strings are ASCII anyway) and
+    serialized back to bytes.
+    """
 
     def _parse(self, raw):
-        return OrderedDict(
-            parse_qsl(raw, keep_blank_values=True, strict_parsing=True)
-        )
+        query = raw.decode('latin-1') if isinstance(raw, bytes) else raw
+        parsed = OrderedDict()
+        spans = OrderedDict()
+        original = {}
+        pos = 0
+        for piece in query.split('&') if query else []:
+            if '=' not in piece:
+                raise ValueError("bad query field: {0!r}".format(piece))
+            k, _, v = piece.partition('=')
+            key = unquote_plus(k)
+            parsed[key] = unquote_plus(v)
+            spans.setdefault(key, []).append((pos + len(k) + 1, pos + len(piece)))
+            original.setdefault(key, []).append(parsed[key])
+            pos += len(piece) + 1
+        self._query = query
+        self._spans = spans
+        # Every value of each key, since a key can be repeated and only the
+        # last value is in parsed.
+        self._original = original
+        return parsed
+
+    def __setitem__(self, key, value):
+        # Setting a repeated key changes the values before the last one too,
+        # even if the last one is already value.
+        if self._original.get(key) == [value] and self.parsed.get(key) == value:
+            return
+        self.parsed[key] = value
+        self.dirty = True
 
     def _unparse(self, parsed, raw):
-        return '&'.join('{0}={1}'.format(quote(k), quote(v))
-                        for k, v in parsed.items())
+        if any(k not in parsed for k in self._spans):
+            # Something was deleted, so start from scratch.
+            query = '&'.join('{0}={1}'.format(quote(k), quote(v))
+                             for k, v in parsed.items())
+        else:
+            query = self._query
+            # Each span of a key is set to its new value if any of its
+            # original values differ, not just the last one.
+            edits = sorted(
+                (start, end, quote(parsed[k]))
+                for k, spans in self._spans.items()
+                if any(v != parsed[k] for v in self._original[k])
+                for start, end in spans
+            )
+            if edits:
+                out = []
+                pos = 0
+                for start, end, value in edits:
+                    out.append(query[pos:start])
+                    out.append(value)
+                    pos = end
+                out.append(query[pos:])
+                query = ''.join(out)
+            added = ['{0}={1}'.format(quote(k), quote(v))
+                     for k, v in parsed.items() if k not in self._spans]
+            if added:
+                query = '&'.join(([query] if query else []) + added)
+        return query.encode('latin-1') if isinstance(raw, bytes) else query
 
 
 class UrlParser(QueryParser):
@@ -95,15 +180,46 @@ class UrlParser(QueryParser):
 
 
 class MultipartParser(BaseParser):
+    """
+    Mapping of form field names to part content. Iterating yields the parts
+    themselves, so that filters can inspect headers (see filter_uploads).
+    """
 
     def _parse(self, raw):
         return multipart.MultiPartFormData(raw)
 
     def _unparse(self, parsed, raw):
-        return str(parsed)
+        return bytes(parsed)
+
+    @staticmethod
+    def _decode(content):
+        try:
+            return content.decode('utf-8')
+        except UnicodeDecodeError:
+            return content.decode('latin-1')
+
+    def __getitem__(self, key):
+        return self._decode(super(MultipartParser, self).__getitem__(key).content)
+
+    def __setitem__(self, key, value):
+        # Like QueryParser, setting a repeated field sets every part with
+        # that name, not just the first one that's returned.
+        parts = self.parsed.parts
+        for i in self.parsed.find_all(key):
+            if self._decode(parts[i].content) != value:
+                parts[i].content = value
+
+    def is_dirty(self):
+        return self.dirty or self.parsed.modified
 
 
 class BatchParser(BaseParser):
+    """
+    Sequence of the requests in a batch, decoded from JSON. make_body_filter
+    rewrites batches in place with rewrite_batch instead, so this is only
+    kept for API compatibility (and as the baseline in
+    benchmarks/batch_rewrite.py).
+    """
 
     def _parse(self, raw):
         return json.loads(raw)
@@ -112,14 +228,13 @@ class BatchParser(BaseParser):
         return json.dumps(parsed, sort_keys=True, separators=',:')
 
 
-
 def make_parsed_filter(filter, parser_class, **kwargs):
     @wraps(filter)
     def wrapper(raw):
         data = parser_class(raw, **kwargs)
         if data:
             data = filter(data)
-            raw = str(data)
+            raw = data.serialize()
         return raw
     return wrapper
 
@@ -136,18 +251,76 @@ def make_multipart_filter(filter, **kwargs):
     return make_parsed_filter(filter, MultipartParser, **kwargs)
 
 
-def make_elider_filter(key, fun, prefix):
+def chain_filters(filters):
+    filters = list(filters)
+    def chained_filter(data):
+        for f in filters:
+            data = f(data)
+        return data
+    return chained_filter
+
+
+def make_elider_filter(key, fun, prefix, cache=None, counters=None):
+    """
+    Make a filter that elides data[key] with fun(data), falling back to
+    fallback_elider. If cache is given (see cache.LRUCache) then the elided
+    value is memoized by (key, original value). If counters is given then
+    "elided.<key>" is incremented for each value elided.
+    """
+    counter_key = 'elided.' + key
+
+    def elide(data):
+        value = fun(data) if fun else None
+        if not value:
+            value = fallback_elider(data[key])
+        return prefix + value
+
     def filter(data):
-        if key in data and (not prefix or
-                            not data[key].startswith(prefix)):
-            value = fun(data) if fun else None
-            if not value:
-                value = fallback_elider(data[key])
-            data[key] = prefix + value
+        if key in data and prefix and data[key].startswith(prefix):
+            # Already elided, but if the key is repeated (see QueryParser)
+            # the other values have to be replaced too.
+            data[key] = data[key]
+        elif key in data:
+            if cache is None:
+                data[key] = elide(data)
+            else:
+                data[key] = cache.get((key, data[key]), lambda: elide(data))
+            if counters is not None:
+                counters[counter_key] += 1
         return data
     return filter
 
 
+def make_prescan_filter(filter, markers, counters=None, name='filter'):
+    """
+    Wrap filter so that it only runs when the raw input contains at least one
+    of the markers. Anything else is returned untouched without being parsed.
+    This is a plain substring check so it works on both bytes and text.
+
+    If counters is given (typically a collections.Counter) then
+    "<name>.fast_path" or "<name>.filtered" is incremented for each call.
+    """
+    text_markers = tuple(m.decode('ascii') if isinstance(m, bytes) else m
+                         for m in markers)
+    byte_markers = tuple(m.encode('ascii') for m in text_markers)
+    fast_path_key = name + '.fast_path'
+    filtered_key = name + '.filtered'
+
+    @wraps(filter)
+    def prescan_filter(raw, *args, **kwargs):
+        if raw:
+            for m in (text_markers if isinstance(raw, type('')) else
+                      byte_markers):
+                if m in raw:
+                    if counters is not None:
+                        counters[filtered_key] += 1
+                    return filter(raw, *args, **kwargs)
+        if counters is not None:
+            counters[fast_path_key] += 1
+        return raw
+    return prescan_filter
+
+
 def fallback_elider(orig):
     if not isinstance(orig, bytes):
         orig = orig.encode('utf-8')
@@ -155,6 +328,11 @@ def fallback_elider(orig):
 
 
 def make_batch_relative_url_filter(filter, **kwargs):
+    """
+    Filter the relative_url of each request in a batch body by decoding and
+    re-encoding the batch. Kept for API compatibility: make_body_filter
+    handles batches itself, with rewrite_batch.
+    """
     url_filter = make_url_filter(filter, **kwargs)
     def batch_relative_url_filter(raw):
         query = QueryParser(raw, **kwargs)
@@ -163,8 +341,154 @@ def make_batch_relative_url_filter(filter, **kwargs):
             if batch:
                 for req in batch:
                     if 'relative_url' in req:
-                        req['relative_url'] = url_filter(req['relative_url'])
-                query['batch'] = str(batch)
-            raw = str(query)
+                        url = url_filter(req['relative_url'])
+                        if url is not req['relative_url']:
+                            req['relative_url'] = url
+                            batch.dirty = True
+                query['batch'] = batch.serialize()
+            raw = query.serialize()
         return raw
     return batch_relative_url_filter
+
+
+# A "relative_url" or "body" key, and a JSON string. In valid JSON an
+# unescaped quote followed by a key name and another quote can only be the
+# key itself, since a closing quote must be followed by punctuation. So it's
+# enough to check that the opening quote isn't escaped, rather than
+# tokenizing every string in the batch.
+BATCH_KEY_RE = re.compile(r'"(relative_url|body)"\s*:\s*')
+JSON_STRING_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+encode_json_string = json.encoder.encode_basestring_ascii
+
+
+def rewrite_batch(batch, url_filter, body_filter):
+    """
+    Run url_filter on the relative_url, and body_filter on the body, of each
+    request in a batch (a JSON array, as text). Rather than decoding and
+    re-encoding the whole batch, this finds those string values and splices
+    in only the ones that changed. Returns the original batch when nothing
+    changed.
+    """
+    out = []
+    pos = 0
+    for key in BATCH_KEY_RE.finditer(batch):
+        i = key.start()
+        while i > 0 and batch[i - 1] == '\\':
+            i -= 1
+        if (key.start() - i) % 2:
+            continue
+        m = JSON_STRING_RE.match(batch, key.end())
+        if not m:
+            continue
+        token = m.group(0)
+        if '\\' not in token:
+            value = token[1:-1]
+        else:
+            try:
+                value = json.loads(token)
+            except ValueError:
+                continue
+        new_value = (url_filter if key.group(1) == 'relative_url' else
+                     body_filter)(value)
+        if new_value is value or new_value == value:
+            continue
+        out.append(batch[pos:m.start()])
+        out.append(encode_json_string(new_value))
+        pos = m.end()
+    if not out:
+        return batch
+    out.append(batch[pos:])
+    return ''.join(out)
+
+
+# Body formats, as chosen by body_format() from a content-type header.
+QUERY = 'query'
+MULTIPART = 'multipart'
+JSON = 'json'
+OPAQUE = 'opaque'
+
+_MEDIA_TYPE_FORMATS = {
+    'application/x-www-form-urlencoded': QUERY,
+    'multipart/form-data': MULTIPART,
+    'application/json': JSON,
+    'text/javascript': JSON,
+    'application/octet-stream': OPAQUE,
+}
+
+_MAJOR_TYPE_FORMATS = {
+    'audio': OPAQUE,
+    'image': OPAQUE,
+    'video': OPAQUE,
+}
+
+_body_formats = {}
+_BODY_FORMATS_MAX = 256
+
+
+def body_format(content_type):
+    """
+    Return the body format for a content-type header, or None when the type
+    is missing or unfamiliar, in which case the body has to be sniffed.
+    """
+    # Keyed on the header as it is, so that a hit skips parsing it.
+    try:
+        return _body_formats[content_type]
+    except KeyError:
+        pass
+    media_type = content_type.partition(';')[0].strip().lower()
+    format = _MEDIA_TYPE_FORMATS.get(media_type)
+    if format is None:
+        if media_type.endswith('+json'):
+            format = JSON
+        else:
+            format = _MAJOR_TYPE_FORMATS.get(media_type.partition('/')[0])
+    # A multipart header's boundary is different every time, so it would
+    # only fill up the cache.
+    if format != MULTIPART and len(_body_formats) < _BODY_FORMATS_MAX:
+        _body_formats[content_type] = format
+    return format
+
+
+def make_body_filter(filters, upload_filter=None, counters=None, **kwargs):
+    """
+    Build a filter for a request body that might be multipart/form-data, a
+    query string, or a query string carrying a batch. The body is parsed
+    once, all the filters are applied to the parsed data (and to the
+    relative_url of each batched request), then it is serialized once.
+
+    Batches are rewritten in place by rewrite_batch rather than being
+    decoded and re-encoded.
+
+    The returned filter takes the body format from body_format() so that
+    only the matching parser is tried. JSON and opaque bodies are returned
+    as-is, and an unknown format falls back to trying each parser in turn.
+    If counters is given then "body.unparsed" is incremented for each body
+    that none of the parsers could handle.
+    """
+    filter = chain_filters(filters)
+    multipart_filter = chain_filters(
+        ([upload_filter] if upload_filter else []) + [filter])
+    url_filter = make_url_filter(filter, **kwargs)
+    query_filter = make_query_filter(filter, **kwargs)
+
+    def body_filter(raw, format=None):
+        if not raw or format in (JSON, OPAQUE):
+            return raw
+
+        if format in (None, MULTIPART):
+            parts = MultipartParser(raw, **kwargs)
+            if parts:
+                return multipart_filter(parts).serialize()
+
+        if format in (None, QUERY):
+            query = QueryParser(raw, **kwargs)
+            if query:
+                if 'batch' in query:
+                    query['batch'] = rewrite_batch(query['batch'], url_filter,
+                                                   query_filter)
+                return filter(query).serialize()
+
+        if counters is not None:
+            counters['body.unparsed'] += 1
+        return raw
+    return body_filter
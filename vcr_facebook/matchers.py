@@ -0,0 +1,93 @@
+from __future__ import absolute_import, unicode_literals, print_function
+
+import hashlib
+
+from .compat import text_type, urlsplit
+from .filters import QUERY, body_format
+from .util import get_header
+
+
+KEY_ATTR = '_vcr_facebook_key'
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def request_key(request):
+    """
+    Return the canonical key of a request that has already been through
+    before_record, so that tokens are elided and the multipart boundary is
+    normalized. The key is made of the method, scheme, host, port, path and
+    sorted query parameters, and a digest of the content-type and body. The
+    body of a form is also taken with its parameters sorted.
+
+    The key is remembered on the request along with the method, uri, body and
+    content-type it was made from, and made again if any of them change. VCR.py
+    copies recorded requests before running before_record on them, so a key
+    that was made before then doesn't describe the sanitized request.
+    """
+    state = (request.method, request.uri,
+             get_header(request.headers, 'content-type'))
+    body = request_body(request)
+    cached = getattr(request, KEY_ATTR, None)
+    if cached is not None and cached[0] == state and cached[1] is body:
+        return cached[2]
+    key = _request_key(request, body)
+    setattr(request, KEY_ATTR, (state, body, key))
+    return key
+
+
+def request_body(request):
+    """
+    Return the body of a request. VCR.py's Request keeps the body of a
+    request made with a file or iterable as bytes or a list of chunks, but
+    makes a new stream of them each time its body is read, so they're taken
+    directly.
+    """
+    body = getattr(request, '_body', None)
+    if not isinstance(body, (bytes, text_type, list)):
+        body = request.body
+    return body
+
+
+def _request_key(request, body):
+    url = urlsplit(request.uri)
+    content_type = get_header(request.headers, 'content-type')
+
+    body = body or b''
+    if hasattr(body, 'read'):
+        body = body.read()
+    elif not isinstance(body, (bytes, text_type, bytearray, memoryview)):
+        body = b''.join(c.encode('utf-8') if isinstance(c, text_type) else c
+                        for c in body)
+    if isinstance(body, text_type):
+        body = body.encode('utf-8')
+    elif not isinstance(body, bytes):
+        body = bytes(body)
+    if body_format(content_type) == QUERY:
+        body = b'&'.join(sorted(body.split(b'&')))
+    digest = hashlib.md5(content_type.encode('utf-8') + b'\n' + body)
+
+    return (
+        request.method.upper(),
+        url.scheme,
+        url.hostname,
+        url.port or DEFAULT_PORTS.get(url.scheme),
+        url.path,
+        '&'.join(sorted(url.query.split('&'))),
+        digest.digest(),
+    )
+
+
+def facebook(r1, r2):
+    """
+    VCR.py matcher comparing the canonical keys of two requests (see
+    request_key). Register it with register_matcher, and use it in place of
+    method, uri, headers and raw_body.
+    """
+    assert request_key(r1) == request_key(r2), "canonical keys differ"
+
+
+def register_matcher(my_vcr, name='facebook'):
+    """
+    Register the facebook matcher on a VCR instance under name.
+    """
+    my_vcr.register_matcher(name, facebook)
@@ -2,14 +2,31 @@
 Minimal hack for modifying multipart/form-data in HTTP traces.
 
 This doesn't use cgi.parse_multipart() because that doesn't maintain key order.
-It's easier to minimally disturb the data with split/join than a full parse.
+It's easier to minimally disturb the data by finding the offsets of each part
+than with a full parse. Parts refer back to the original body, and are only
+copied into new bytes when they're modified.
 """
 from __future__ import absolute_import, unicode_literals
 
+import re
+
+from .compat import byte_view, text_type
+
 
 CRNL = b'\r\n'
 CRNL2 = CRNL * 2
 
+NAME_RE = re.compile(br'; name="([^"]*)"')
+FILENAME_RE = re.compile(br'; filename="([^"]*)"')
+
+
+def _to_bytes(s):
+    if isinstance(s, text_type):
+        return s.encode('utf-8')
+    if isinstance(s, memoryview):
+        return s.tobytes()
+    return s
+
 
 class MultiPartFormData(object):
     """
@@ -26,38 +43,59 @@ class MultiPartFormData(object):
 
     How to use it:
 
-        >>> parts = MultiPartFormData('---xxxboundary123\r\n'
-                                      'Content-Disposition: form-data; name="access_token"\r\n'
-                                      '\r\n'
-                                      'abcde12345abcde12345\r\n')
-        >>> parts.get('access_token')
-        abcde12345abcde12345
-        >>> parts['access_token'] = 'redacted'
-        >>> str(parts)
-        ---xxxboundary123
-        Content-Disposition: form-data; name="access_token"
-
-        redacted
+        >>> parts = MultiPartFormData(b'--xxxboundary123\r\n'
+                                      b'Content-Disposition: form-data; name="access_token"\r\n'
+                                      b'\r\n'
+                                      b'abcde12345abcde12345\r\n'
+                                      b'--xxxboundary123--\r\n')
+        >>> parts['access_token'].content
+        b'abcde12345abcde12345'
+        >>> parts['access_token'].content = b'redacted'
+        >>> bytes(parts)
+        b'--xxxboundary123\r\nContent-Disposition: form-data; name="access_token"\r\n\r\nredacted\r\n--xxxboundary123--\r\n'
     """
 
     def __init__(self, body):
-        if isinstance(body, unicode):
-            body = bytes(body)
+        body = _to_bytes(body)
 
         if not body.startswith(b'--'):
             raise ValueError("Doesn't appear to be a multipart/form-data")
 
-        self.boundary = body.split(CRNL, 1)[0][2:]
-
-        assert body.startswith(self._leader)
-        assert body.endswith(self._terminator)
-
-        inner_body = body[len(self._leader):-len(self._terminator)]
-        self.parts = [MultiPartPart(p) for p in inner_body.split(self._splitter)]
+        eol = body.find(CRNL)
+        if eol < 0:
+            raise ValueError("Doesn't appear to be a multipart/form-data")
+        self.boundary = self._original_boundary = bytes(body[2:eol])
+
+        if not body.endswith(self._terminator):
+            raise ValueError("Missing multipart/form-data terminator")
+
+        # Scan once for the offsets of each part.
+        view = byte_view(body)
+        splitter = self._splitter
+        start = len(self._leader)
+        end = len(body) - len(self._terminator)
+        parts = []
+        while True:
+            i = body.find(splitter, start, end)
+            if i < 0:
+                parts.append(MultiPartPart._from_buffer(body, view, start, end))
+                break
+            parts.append(MultiPartPart._from_buffer(body, view, start, i))
+            start = i + len(splitter)
+        self.parts = parts
+
+    def __bytes__(self):
+        chunks = [self._leader]
+        for i, p in enumerate(self.parts):
+            if i:
+                chunks.append(self._splitter)
+            chunks.extend(p._chunks())
+        chunks.append(self._terminator)
+        return b''.join(chunks)
 
-    def __str__(self):
-        inner_body = self._splitter.join(str(p) for p in self.parts)
-        return b''.join([self._leader, inner_body, self._terminator])
+    if bytes is str:
+        # python 2
+        __str__ = __bytes__
 
     @property
     def parts(self):
@@ -67,25 +105,52 @@ class MultiPartFormData(object):
     def parts(self, parts):
         assert all(isinstance(p, MultiPartPart) for p in parts)
         self._parts = parts
+        self._index = None
+        for p in parts:
+            p._on_header_change = self._invalidate_index
 
     @property
-    def _leader(self):
-        return b'--' + self.boundary + CRNL
+    def modified(self):
+        """Whether anything has changed since the body was parsed."""
+        return (self._boundary != self._original_boundary or
+                any(p.modified for p in self._parts))
+
+    def _invalidate_index(self):
+        self._index = None
 
     @property
-    def _splitter(self):
-        return CRNL + b'--' + self.boundary + CRNL
+    def index(self):
+        """
+        Mapping of field name to the indexes of the parts with that name, in
+        order. This is built from the parts on first use, and rebuilt after
+        parts is set or a part's header changes. (Modifying the parts list in
+        place isn't tracked, so assign a new list instead.)
+        """
+        if self._index is None:
+            index = {}
+            for i, p in enumerate(self._parts):
+                if p.name is not None:
+                    index.setdefault(p.name, []).append(i)
+            self._index = index
+        return self._index
 
     @property
-    def _terminator(self):
-        return CRNL + b'--' + self.boundary + b'--' + CRNL
+    def boundary(self):
+        return self._boundary
+
+    @boundary.setter
+    def boundary(self, boundary):
+        self._boundary = boundary = _to_bytes(boundary)
+        self._leader = b'--' + boundary + CRNL
+        self._splitter = CRNL + b'--' + boundary + CRNL
+        self._terminator = CRNL + b'--' + boundary + b'--' + CRNL
 
     def find(self, key):
-        name = b'; name="{0}"'.format(key)
-        for i, p in enumerate(self.parts):
-            if name in p.header:
-                return i
-        return -1
+        indexes = self.find_all(key)
+        return indexes[0] if indexes else -1
+
+    def find_all(self, key):
+        return self.index.get(_to_bytes(key), [])
 
     def __getitem__(self, key):
         i = self.find(key)
@@ -99,6 +164,9 @@ class MultiPartFormData(object):
     def __iter__(self):
         return iter(self.parts)
 
+    def __len__(self):
+        return len(self.parts)
+
     def get(self, key, default=None):
         try:
             return self[key]
@@ -107,27 +175,188 @@ class MultiPartFormData(object):
 
 
 class MultiPartPart(object):
+    """
+    One part of a multipart/form-data body: a header and content separated by
+    a blank line.
+
+    A part made by MultiPartFormData refers to a range of the original body.
+    The header and content are sliced out (and cached) on first access, and
+    the part is only rebuilt from them once one of them is set.
+    """
 
     def __init__(self, s):
+        s = _to_bytes(s)
         assert isinstance(s, bytes)
-        self.bytes = s
+        self._init(s, byte_view(s), 0, len(s))
+
+    @classmethod
+    def _from_buffer(cls, buf, view, start, end):
+        part = cls.__new__(cls)
+        part._init(buf, view, start, end)
+        return part
+
+    def _init(self, buf, view, start, end):
+        self._buf = buf
+        self._view = view
+        self._start = start
+        self._end = end
+        self._header_end = buf.find(CRNL2, start, end)
+        if self._header_end < 0:
+            raise ValueError("Missing blank line after multipart headers")
+        self._header = None
+        self._content = None
+        self._modified = False
+        self._disposition = None
+        self._on_header_change = None
+
+    def _chunks(self):
+        if self._modified:
+            return [self.header, CRNL2, self.content]
+        return [self._view[self._start:self._end]]
+
+    def __bytes__(self):
+        return b''.join(self._chunks())
+
+    if bytes is str:
+        # python 2
+        __str__ = __bytes__
+
+    @property
+    def bytes(self):
+        return self.__bytes__()
 
-    def __str__(self):
-        return self.bytes
+    @property
+    def modified(self):
+        return self._modified
 
     @property
     def header(self):
-        return self.bytes.split(CRNL2, 1)[0]
+        if self._header is None:
+            self._header = bytes(self._buf[self._start:self._header_end])
+        return self._header
 
     @header.setter
     def header(self, value):
+        value = _to_bytes(value)
         assert isinstance(value, bytes)
-        self.bytes = CRNL2.join([value, self.content])
+        self.content  # materialize before the header changes
+        self._header = value
+        self._modified = True
+        self._disposition = None
+        if self._on_header_change is not None:
+            self._on_header_change()
+
+    def _parse_disposition(self):
+        if self._disposition is None:
+            header = self.header
+            name = NAME_RE.search(header)
+            filename = FILENAME_RE.search(header)
+            self._disposition = (name and name.group(1),
+                                 filename and filename.group(1))
+        return self._disposition
+
+    @property
+    def name(self):
+        """The form field name from the header, or None."""
+        return self._parse_disposition()[0]
+
+    @property
+    def filename(self):
+        """The uploaded file name from the header, or None."""
+        return self._parse_disposition()[1]
+
+    @property
+    def content_view(self):
+        """
+        The content without copying it: a memoryview on python 3, suitable
+        for hashing or len().
+        """
+        if self._content is not None:
+            return self._content
+        return self._view[self._header_end + len(CRNL2):self._end]
 
     @property
     def content(self):
-        return self.bytes.split(CRNL2, 1)[1]
+        if self._content is None:
+            self._content = _to_bytes(self.content_view)
+        return self._content
 
     @content.setter
     def content(self, value):
-        self.bytes = CRNL2.join([self.header, value])
+        self.header  # materialize before the content changes
+        self._content = _to_bytes(value)
+        self._modified = True
+
+
+def iter_multipart(chunks, max_header_size=64 * 1024):
+    """
+    Parse a multipart/form-data body that arrives as an iterable of byte
+    chunks, without holding more than about a chunk of it at a time.
+
+    Yields events as (kind, data) tuples:
+
+        ('boundary', boundary)  first, sniffed from the start of the body
+        ('header', header)      at the start of each part
+        ('content', bytes)      zero or more times per part
+        ('end', None)           at the end of each part
+
+    Raises ValueError if the body doesn't look like multipart/form-data or
+    ends early.
+    """
+    chunks = (_to_bytes(c) for c in chunks)
+
+    def more(buf):
+        for chunk in chunks:
+            if chunk:
+                return buf + chunk
+        raise ValueError("Truncated multipart/form-data")
+
+    buf = b''
+    while CRNL not in buf:
+        if len(buf) > max_header_size:
+            raise ValueError("Doesn't appear to be a multipart/form-data")
+        buf = more(buf)
+    if not buf.startswith(b'--'):
+        raise ValueError("Doesn't appear to be a multipart/form-data")
+    eol = buf.find(CRNL)
+    boundary = buf[2:eol]
+    yield 'boundary', boundary
+
+    delimiter = CRNL + b'--' + boundary
+    buf = buf[eol + len(CRNL):]
+    while True:
+        # Header, up to the blank line.
+        while True:
+            i = buf.find(CRNL2)
+            if i >= 0:
+                break
+            if len(buf) > max_header_size:
+                raise ValueError("Multipart header too long")
+            buf = more(buf)
+        yield 'header', buf[:i]
+        buf = buf[i + len(CRNL2):]
+
+        # Content, up to the next delimiter. Anything that can't be the start
+        # of a delimiter is passed on straight away.
+        while True:
+            i = buf.find(delimiter)
+            if i >= 0:
+                break
+            safe = len(buf) - len(delimiter) + 1
+            if safe > 0:
+                yield 'content', buf[:safe]
+                buf = buf[safe:]
+            buf = more(buf)
+        if i:
+            yield 'content', buf[:i]
+        yield 'end', None
+        buf = buf[i + len(delimiter):]
+
+        # Either another part or the terminator.
+        while len(buf) < 2:
+            buf = more(buf)
+        if buf.startswith(b'--'):
+            return
+        if not buf.startswith(CRNL):
+            raise ValueError("Malformed multipart/form-data delimiter")
+        buf = buf[len(CRNL):]
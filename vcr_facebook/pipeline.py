@@ -0,0 +1,85 @@
+from __future__ import absolute_import, unicode_literals, print_function
+
+import collections
+
+
+class Pipeline(object):
+    """
+    An immutable sequence of named stages, built once when the VCR kwargs are
+    made and then reused for every request or response.
+
+    Each stage is a (name, callable) pair where the callable takes the object
+    being filtered and returns it (possibly modified, possibly replaced).
+    The optional applies predicate decides whether the pipeline runs at all,
+    otherwise the object is returned untouched.
+
+    The counters are shared with the stages that were built for this
+    pipeline, so they report what happened across every call.
+
+    If stats (see stats.Stats) is given then each stage is timed, and
+    recorded as "<name>.<stage>" along with size(obj) before and after.
+    """
+
+    def __init__(self, stages, applies=None, counters=None, stats=None,
+                 name='pipeline', size=None):
+        self._stages = tuple((name, stage) for name, stage in stages)
+        self._applies = applies
+        self.counters = (collections.Counter() if counters is None else
+                         counters)
+        self.stats = stats
+        self.name = name
+        self._size = size or (lambda obj: None)
+
+    @property
+    def stages(self):
+        return self._stages
+
+    @property
+    def names(self):
+        return tuple(name for name, _ in self._stages)
+
+    def extend(self, *stages):
+        """Return a new pipeline with the given stages appended."""
+        return self.__class__(self._stages + stages, applies=self._applies,
+                              counters=self.counters, stats=self.stats,
+                              name=self.name, size=self._size)
+
+    def __call__(self, obj):
+        if self.stats is not None:
+            return self._call_timed(obj)
+        if self._applies is not None and not self._applies(obj):
+            return obj
+        for _, stage in self._stages:
+            obj = stage(obj)
+        return obj
+
+    def _call_timed(self, obj):
+        if self._applies is not None and not self._applies(obj):
+            self.counters[self.name + '.skipped'] += 1
+            return obj
+        timer, record, size = self.stats.timer, self.stats.record, self._size
+        for name, stage in self._stages:
+            bytes_in = size(obj)
+            start = timer()
+            obj = stage(obj)
+            record(self.name + '.' + name, timer() - start, bytes_in, size(obj))
+        return obj
+
+    def __iter__(self):
+        return iter(self._stages)
+
+    def __len__(self):
+        return len(self._stages)
+
+    def __repr__(self):
+        return '<{0} {1}>'.format(type(self).__name__, list(self.names))
+
+
+def make_attr_stage(attr, filter):
+    """
+    Make a stage that runs filter on a single attribute of the object.
+    """
+    def stage(obj):
+        setattr(obj, attr, filter(getattr(obj, attr)))
+        return obj
+    return stage
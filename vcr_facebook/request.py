@@ -1,19 +1,33 @@
 from __future__ import absolute_import, unicode_literals, print_function
 
+import collections
 import hashlib
+import itertools
 import logging
 import re
 import zlib
 
-from .compat import OrderedDict, parse_qsl, quote
-from .filters import (make_batch_relative_url_filter, make_multipart_filter, make_query_filter,
-                      make_url_filter, make_elider_filter)
-from .util import always_return
+from .cache import LRUCache
+from .compat import text_type
+from .fields import BODY, URL, default_fields
+from .filters import (MULTIPART, OPAQUE, body_format, make_body_filter,
+                      make_prescan_filter, make_url_filter)
+from .multipart import CRNL, CRNL2, FILENAME_RE, iter_multipart
+from .pipeline import Pipeline, make_attr_stage
+from .util import get_header, set_header
 
 
 logger = logging.getLogger(__name__)
 
 
+# Besides the names of the sensitive fields, a body with a file upload has to
+# be parsed. Anything without any of these skips parsing entirely.
+BODY_MARKERS = ('filename="',)
+
+# How much of a file-like or iterable request body to read at a time.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
 def wrap_before_record(wrapped, **kwargs):
     before_record = make_before_record(**kwargs)
     def wrapper(request):
@@ -26,101 +40,400 @@ def wrap_before_record(wrapped, **kwargs):
 def make_before_record(elide_appsecret_proof,
                        elide_access_token,
                        elide_client_secret,
-                       elider_prefix):
-
-    appsecret_proof_filter = make_elider_filter(
-        'appsecret_proof',
-        elide_appsecret_proof and (
-            lambda q: elide_appsecret_proof(q['appsecret_proof'],
-                                            q['access_token'])),
-        elider_prefix,
-    )
+                       elider_prefix,
+                       elision_cache=None,
+                       upload_hash='md5',
+                       upload_cache=None,
+                       stream_chunk_size=STREAM_CHUNK_SIZE,
+                       fields=None,
+                       stats=None,
+                       request_cache=None):
 
-    access_token_filter = make_elider_filter(
-        'access_token',
-        elide_access_token and (
-            lambda q: elide_access_token(q['access_token'])),
-        elider_prefix,
+    counters = collections.Counter() if stats is None else stats.counters
+
+    # fields is a compiled fields.FieldMatcher, normally shared with
+    # make_before_record_response. The elide_* callbacks are only used for
+    # the default fields when it isn't given.
+    if fields is None:
+        fields = default_fields(
+            elide_appsecret_proof=elide_appsecret_proof,
+            elide_access_token=elide_access_token,
+            elide_client_secret=elide_client_secret,
+        ).compile(elider_prefix, elision_cache, stats and stats.counters)
+
+    _filter_body = make_stream_body_filter(
+        make_prescan_filter(
+            make_body_filter(
+                [fields.filter(BODY)],
+                upload_filter=make_upload_filter(upload_hash, upload_cache),
+                counters=stats and stats.counters,
+            ),
+            fields.markers(BODY) + BODY_MARKERS, counters, 'body',
+        ),
+        upload_hash, stream_chunk_size, upload_cache=upload_cache,
     )
 
-    input_token_filter = make_elider_filter(
-        'input_token',
-        elide_access_token and (
-            lambda q: elide_access_token(q['input_token'])),
-        elider_prefix,
+    _filter_url = make_prescan_filter(
+        make_url_filter(fields.filter(URL)),
+        fields.markers(URL), counters, 'url',
     )
 
-    client_secret_filter = make_elider_filter(
-        'client_secret',
-        elide_client_secret and (
-            lambda q: elide_client_secret(q['client_secret'])),
-        elider_prefix,
+    kwargs = {}
+    pipeline_class = Pipeline
+    if request_cache is not None:
+        kwargs['cache'] = request_cache
+        pipeline_class = CachedPipeline
+    return pipeline_class(
+        [
+            ('body', make_body_stage(_filter_body)),
+            ('headers', make_attr_stage('headers', filter_headers)),
+            ('url', make_attr_stage('uri', _filter_url)),
+        ],
+        applies=lambda request: request.host == 'graph.facebook.com',
+        counters=counters,
+        stats=stats,
+        name='request',
+        size=request_size,
+        **kwargs
     )
 
-    def _filter_body(body):
-        filters = [
-            make_multipart_filter(filter_uploads),
-            make_batch_relative_url_filter(appsecret_proof_filter),
-            make_batch_relative_url_filter(access_token_filter),
-            make_batch_relative_url_filter(input_token_filter),
-            make_batch_relative_url_filter(client_secret_filter),
-            make_query_filter(appsecret_proof_filter),
-            make_query_filter(access_token_filter),
-            make_query_filter(input_token_filter),
-            make_query_filter(client_secret_filter),
-            make_multipart_filter(appsecret_proof_filter),
-            make_multipart_filter(access_token_filter),
-            make_multipart_filter(input_token_filter),
-            make_multipart_filter(client_secret_filter),
-        ]
-        for f in filters:
-            body = f(body)
-        return body
-
-    def _filter_headers(headers):
-        if 'content-length' in headers:
-            del headers['content-length']
-        return headers
-
-    def _filter_url(url):
-        filters = [
-            make_url_filter(appsecret_proof_filter),
-            make_url_filter(access_token_filter),
-            make_url_filter(client_secret_filter),
-        ]
-        for f in filters:
-            url = f(url)
-        return url
-
-    def before_record(request):
-        if request.host != 'graph.facebook.com':
-            return request
-        request.body = _filter_body(request.body)
-        request.headers = _filter_headers(request.headers)
-        request.uri = _filter_url(request.uri)
-        request = filter_multipart_boundary(request)
+
+def request_size(request):
+    body = request.body
+    if isinstance(body, (bytes, text_type, bytearray, memoryview)):
+        return len(body)
+    return None
+
+
+def request_fingerprint(request):
+    """
+    Return a key for everything before_record looks at in a request, or None
+    if the body is a stream. The body itself is part of the key, so that
+    bodies are compared in full on a hit. Bytes are immutable and cache their
+    hash, so this doesn't copy a bytes body or hash it more than once.
+    """
+    body = request.body
+    if body is None:
+        body = b''
+    elif isinstance(body, text_type):
+        body = body.encode('utf-8')
+    elif isinstance(body, (bytearray, memoryview)):
+        body = bytes(body)
+    elif not isinstance(body, bytes):
+        return None
+    return (request.method, request.uri,
+            get_header(request.headers, 'content-type'), body)
+
+
+def make_cached_before_record(before_record, cache):
+    """
+    Wrap before_record so that the fields it changes (uri, body and headers)
+    are memoized in cache (see cache.LRUCache) by request_fingerprint. When
+    replaying, VCR.py sanitizes every live request to match it against the
+    cassette, so a request that is sent again is only sanitized once.
+    """
+    def cached_before_record(request):
+        key = request_fingerprint(request)
+        if key is None:
+            return before_record(request)
+
+        computed = []
+        def sanitize():
+            headers = dict(request.headers)
+            new = before_record(request)
+            computed.append(new)
+            return (new.uri, new.body,
+                    [(k, v) for k, v in new.headers.items()
+                     if k not in headers or headers[k] is not v],
+                    [k for k in headers if k not in new.headers])
+        uri, body, changed_headers, removed_headers = cache.get(key, sanitize)
+        if computed:
+            return computed[0]
+
+        request.uri = uri
+        request.body = body
+        for k, v in changed_headers:
+            request.headers[k] = v
+        for k in removed_headers:
+            # The header might not have been sent this time.
+            request.headers.pop(k, None)
         return request
-    return before_record
+
+    return cached_before_record
+
+
+class CachedPipeline(Pipeline):
+    """
+    A request Pipeline that memoizes its results in cache (see
+    make_cached_before_record). A pipeline made by extend() gets a cache of
+    its own, since it doesn't give the same results.
+    """
+
+    def __init__(self, stages, cache, **kwargs):
+        super(CachedPipeline, self).__init__(stages, **kwargs)
+        self.cache = cache
+        self._cached = make_cached_before_record(
+            super(CachedPipeline, self).__call__, cache)
+
+    def extend(self, *stages):
+        return self.__class__(self._stages + stages,
+                              cache=LRUCache(self.cache.maxsize),
+                              applies=self._applies, counters=self.counters,
+                              stats=self.stats, name=self.name,
+                              size=self._size)
+
+    def __call__(self, request):
+        return self._cached(request)
+
+
+def make_body_stage(body_filter):
+    """
+    Make a stage that filters the request body. The boundary of a multipart
+    body is normalized along with its content-type (see
+    normalize_multipart_boundary) once it's been filtered to bytes.
+
+    The body is read once, since VCR.py makes a new stream on each access to
+    the body of a request made with a file or iterable.
+    """
+    def stage(request):
+        content_type = get_header(request.headers, 'content-type')
+        format = body_format(content_type)
+        body = body_filter(request.body, format)
+        if format == MULTIPART and isinstance(body, bytes):
+            body, new_type = normalize_multipart_boundary(body, content_type)
+            if new_type != content_type:
+                set_header(request.headers, 'content-type', new_type)
+        request.body = body
+        return request
+    return stage
+
+
+def filter_headers(headers):
+    if 'content-length' in headers:
+        del headers['content-length']
+    return headers
+
+
+UPLOAD_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_upload(content, algorithm='md5', chunk_size=UPLOAD_HASH_CHUNK_SIZE):
+    """
+    Return the hex digest of content (bytes or memoryview), feeding the hash
+    a chunk at a time through a memoryview so that nothing is copied.
+    """
+    h = hashlib.new(algorithm)
+    view = memoryview(content)
+    for i in range(0, len(view), chunk_size):
+        h.update(view[i:i + chunk_size])
+    return h.hexdigest()
 
 
-def filter_uploads(parts):
-    for p in parts:
-        if b'; filename="' in p.header and len(p.content) > 100:
-            p.content = hashlib.md5(p.content).hexdigest()
-    return parts
+def make_upload_hasher(algorithm='md5', cache=None):
+    """
+    Return a function of content that returns hash_upload(content,
+    algorithm), memoized in cache if it's given (see make_upload_filter).
+    """
+    hashlib.new(algorithm)  # fail early for an unknown algorithm
+    if cache is None:
+        return lambda content: hash_upload(content, algorithm)
+
+    def _hash(content):
+        key = (algorithm, len(content), zlib.crc32(content) & 0xffffffff)
+        cached, digest = cache.get(
+            key, lambda: (bytes(content), hash_upload(content, algorithm)))
+        if cached != content:
+            return hash_upload(content, algorithm)
+        return digest
+    return _hash
+
+
+HEX_DIGEST_RE = re.compile(br'[0-9a-f]+\Z')
+
+
+def make_upload_filter(algorithm='md5', cache=None, min_size=100):
+    """
+    Make a multipart filter that replaces the content of file uploads larger
+    than min_size with their hex digest. Content that is already a hex digest
+    of the algorithm is left alone, so that filtering again (as VCR.py does
+    when it loads a cassette) doesn't hash the digest.
+
+    If cache is given (see cache.LRUCache) then digests are memoized by
+    (algorithm, length, crc32) of the content, along with a copy of the
+    content which is compared on a hit, since CRC-32 can collide. Comparing
+    is much cheaper than computing the digest. This pays off when the same
+    chunk of a resumable upload is sent more than once.
+    """
+    digest_size = hashlib.new(algorithm).digest_size * 2
+    _hash = make_upload_hasher(algorithm, cache)
+
+    def is_digest(content):
+        return (len(content) == digest_size and
+                HEX_DIGEST_RE.match(bytes(content)) is not None)
+
+    def upload_filter(parts):
+        for p in parts:
+            if (p.filename is not None and len(p.content_view) > min_size and
+                    not is_digest(p.content_view)):
+                p.content = _hash(p.content_view)
+        return parts
+    return upload_filter
+
+
+filter_uploads = make_upload_filter()
+
+
+def is_stream(body):
+    """
+    Whether body is a file-like object or an iterable of chunks, rather than
+    a string.
+    """
+    if body is None or isinstance(body, (bytes, text_type, bytearray, memoryview)):
+        return False
+    return hasattr(body, 'read') or hasattr(body, '__iter__')
+
+
+def iter_chunks(body, chunk_size=STREAM_CHUNK_SIZE):
+    if hasattr(body, 'read'):
+        return iter(lambda: body.read(chunk_size), body.read(0))
+    return iter(body)
+
+
+def make_stream_body_filter(body_filter, upload_hash='md5',
+                            chunk_size=STREAM_CHUNK_SIZE, min_upload_size=100,
+                            upload_cache=None):
+    """
+    Wrap body_filter to also accept a body that is a file-like object or an
+    iterable of chunks.
+
+    A multipart/form-data stream is read a chunk at a time, and file uploads
+    are hashed as they go by (see sanitize_multipart_stream). That leaves a
+    body small enough to pass to body_filter as usual, to elide the form
+    fields. Other streams are read in full, except opaque ones which are
+    returned as-is. With upload_cache, digests are memoized as in
+    make_upload_filter, which means holding each upload in memory to look
+    it up.
+
+    Reading consumes the stream. A body that fails to parse is returned as
+    bytes, unchanged. To get them, a file-like body is rewound and read again,
+    and the chunks of any other stream are kept as they're read.
+    """
+    hasher = (make_upload_hasher(upload_hash, upload_cache)
+              if upload_cache is not None else None)
+
+    def stream_body_filter(raw, format=None):
+        if not is_stream(raw):
+            return body_filter(raw, format)
+        if format == OPAQUE:
+            return raw
+
+        pos = raw.tell() if hasattr(raw, 'tell') else None
+        chunks = iter_chunks(raw, chunk_size)
+        try:
+            first = next(chunks)
+        except StopIteration:
+            return b''
+        if isinstance(first, text_type):
+            first = first.encode('utf-8')
+        chunks = (c.encode('utf-8') if isinstance(c, text_type) else c
+                  for c in itertools.chain([first], chunks))
+
+        if format in (None, MULTIPART) and first.startswith(b'--'):
+            read = []
+            if pos is None:
+                chunks = _keep(chunks, read)
+            try:
+                body = sanitize_multipart_stream(chunks, upload_hash,
+                                                 min_upload_size, hasher)
+            except ValueError:
+                logger.debug("Failed to parse multipart stream", exc_info=True)
+                if pos is None:
+                    read.extend(chunks)
+                    return b''.join(read)
+                raw.seek(pos)
+                body = raw.read()
+                return body.encode('utf-8') if isinstance(body, text_type) else body
+        else:
+            body = b''.join(chunks)
+        return body_filter(body, format)
+    return stream_body_filter
+
+
+def _keep(chunks, read):
+    for c in chunks:
+        read.append(c)
+        yield c
+
+
+def sanitize_multipart_stream(chunks, algorithm='md5', min_upload_size=100,
+                              hasher=None):
+    """
+    Read a multipart/form-data body from an iterable of chunks, replacing
+    file uploads larger than min_upload_size with their hex digest (the same
+    as make_upload_filter) as they stream by. Returns the resulting body,
+    which only holds the form fields and digests.
+
+    If hasher is given (see make_upload_hasher), file uploads are collected
+    and passed to it whole instead.
+    """
+    out = []
+    for kind, data in iter_multipart(chunks):
+        if kind == 'boundary':
+            boundary = data
+        elif kind == 'header':
+            header = data
+            is_file = FILENAME_RE.search(header) is not None
+            content = []
+            size = 0
+            h = None
+        elif kind == 'content':
+            if h is not None:
+                h.update(data)
+                continue
+            content.append(data)
+            size += len(data)
+            if is_file and size > min_upload_size and hasher is None:
+                h = hashlib.new(algorithm)
+                for c in content:
+                    h.update(c)
+                content = None
+        elif kind == 'end':
+            if h is not None:
+                content = h.hexdigest().encode('ascii')
+            elif is_file and size > min_upload_size:
+                content = hasher(b''.join(content)).encode('ascii')
+            else:
+                content = b''.join(content)
+            out.append(header + CRNL2 + content)
+    return b''.join([
+        b'--', boundary, CRNL,
+        (CRNL + b'--' + boundary + CRNL).join(out),
+        CRNL, b'--', boundary, b'--', CRNL,
+    ])
 
 
 MULTIPART_BOUNDARY = b'xxBOUNDARY' * 10
 
-def filter_multipart_boundary(request):
-    content_type = request.headers.get('content-type', '')
-    prefix, equals, boundary = content_type.partition('=')
-    if boundary and prefix == 'multipart/form-data; boundary':
-        boundary = MULTIPART_BOUNDARY[:len(boundary)]
-        request.headers['content-type'] = b'{0}={1}'.format(prefix, boundary)
-        def filter(parts):
-            assert len(parts.boundary) == len(boundary)
-            parts.boundary = boundary
-            return parts
-        request.body = make_multipart_filter(filter)(request.body)
-    return request
+
+def normalize_multipart_boundary(body, content_type):
+    """
+    Return body and content_type with the multipart boundary replaced by
+    MULTIPART_BOUNDARY (cut to the same length), so that recordings don't
+    differ by the random boundary. Anything that doesn't start and end with
+    the boundary in content_type, such as a body that failed to parse, is
+    returned as-is.
+
+    The delimiter (a CRLF, "--" and the boundary) can't appear in the
+    content of a part, so this is a plain replace rather than a parse.
+    """
+    prefix, _, boundary = content_type.partition('=')
+    if not boundary or prefix != 'multipart/form-data; boundary':
+        return body, content_type
+    old = boundary.encode('ascii')
+    new = MULTIPART_BOUNDARY[:len(old)]
+    if (old == new or not body.startswith(b'--' + old) or
+            not body.rstrip(CRNL).endswith(b'--' + old + b'--')):
+        return body, content_type
+    body = b'--' + new + body[2 + len(old):].replace(CRNL + b'--' + old,
+                                                     CRNL + b'--' + new)
+    return body, '{0}={1}'.format(prefix, new.decode('ascii'))
@@ -7,8 +7,10 @@ import logging
 import re
 import zlib
 
-from .compat import OrderedDict, parse_qsl, quote
-from .filters import fallback_elider
+from .fields import compile_token_re, default_fields
+from .filters import JSON, QUERY, body_format, fallback_elider
+from .pipeline import Pipeline
+from .util import get_header
 
 
 logger = logging.getLogger(__name__)
@@ -24,27 +26,104 @@ def wrap_before_record_response(wrapped, **kwargs):
 
 
 def make_before_record_response(elide_access_token,
-                                elider_prefix):
+                                elider_prefix,
+                                max_scan_size=None,
+                                gzip_chunk_size=None,
+                                elision_cache=None,
+                                fields=None,
+                                stats=None):
 
-    def before_record_response(response):
+    counters = collections.Counter() if stats is None else stats.counters
+
+    # fields is a compiled fields.FieldMatcher, normally shared with
+    # make_before_record. Only the fields in its RESPONSE scope apply here.
+    if fields is None:
+        fields = default_fields(elide_access_token=elide_access_token).compile(
+            elider_prefix, elision_cache, stats and stats.counters)
+
+    replace = make_token_replace(fields.token_elides, fields.prefix,
+                                 fields.cache, fields.counters)
+    keys, token_re = fields.token_keys, fields.token_re
+
+    def _filter_access_tokens(response):
+        return filter_tokens(response, replace, keys, token_re)
+
+    def _ungzip_filter_access_tokens(response):
+        return ungzip_filter_tokens(response, replace, gzip_chunk_size, keys,
+                                    token_re)
+
+    if gzip_chunk_size:
+        filter_stages = [
+            ('ungzip_access_tokens', _ungzip_filter_access_tokens),
+        ]
+    else:
+        filter_stages = [
+            ('ungzip', ungzip),
+            ('access_tokens', _filter_access_tokens),
+        ]
+
+    def applies(response):
         if 'facebook-api-version' not in response['headers']:
-            return response
-
-        # The response at this point is both (1) what will be recorded, and
-        # (2) what will be returned to the application. The problem is that a
-        # test needs to run through with the original responses the first time,
-        # so that paging links with embedded access tokens are still valid.
-        # Later when the test replays in full, the elided tokens will match
-        # from the response and the request for the next page, but the first
-        # time we have to be careful not to break the paging links.
-        response = copy.deepcopy(response)
-
-        response = ungzip(response)
-        response = filter_access_tokens(
-            response, elide_access_token, elider_prefix)
-        response = update_content_length(response)
-        return response
-    return before_record_response
+            return False
+        content_type = get_header(response['headers'], 'content-type')
+        if not is_textual(content_type):
+            counters['response.skipped_content_type'] += 1
+            return False
+        size = len(response['body']['string'] or b'')
+        if max_scan_size is not None and size > max_scan_size:
+            logger.debug("Not scanning %d byte response (max_scan_size=%d)",
+                         size, max_scan_size)
+            counters['response.skipped_size'] += 1
+            return False
+        counters['response.scanned'] += 1
+        return True
+
+    return Pipeline(
+        [
+            ('copy', copy_response),
+        ] + filter_stages + [
+            ('content_length', update_content_length),
+        ],
+        applies=applies,
+        counters=counters,
+        stats=stats,
+        name='response',
+        size=response_size,
+    )
+
+
+def response_size(response):
+    return len(response['body']['string'] or b'')
+
+
+def is_textual(content_type):
+    """
+    Whether a response with this content-type might carry access tokens.
+    A missing content-type is assumed to be textual, to be on the safe side.
+    """
+    if not content_type:
+        return True
+    if body_format(content_type) in (JSON, QUERY):
+        return True
+    return content_type.lstrip().lower().startswith('text/')
+
+
+def copy_response(response):
+    # The response at this point is both (1) what will be recorded, and
+    # (2) what will be returned to the application. The problem is that a
+    # test needs to run through with the original responses the first time,
+    # so that paging links with embedded access tokens are still valid.
+    # Later when the test replays in full, the elided tokens will match
+    # from the response and the request for the next page, but the first
+    # time we have to be careful not to break the paging links.
+    #
+    # The filters only ever replace values in the headers and body dicts
+    # (never mutate them in place) so it's enough to copy those containers.
+    # The body string itself is shared until it's replaced.
+    response = copy.copy(response)
+    response['headers'] = copy.copy(response['headers'])
+    response['body'] = copy.copy(response['body'])
+    return response
 
 
 def ungzip(response):
@@ -52,57 +131,260 @@ def ungzip(response):
 
     if 'gzip' in headers.get('content-encoding', []):
         body['string'] = zlib.decompress(body['string'], 16 + zlib.MAX_WBITS)
-        headers['content-encoding'].remove('gzip')
-        if not headers['content-encoding']:
-            del headers['content-encoding']
+        _remove_gzip_encoding(headers)
+
+    return response
+
+
+def _remove_gzip_encoding(headers):
+    encodings = list(headers['content-encoding'])
+    encodings.remove('gzip')
+    if encodings:
+        headers['content-encoding'] = encodings
+    else:
+        del headers['content-encoding']
+
+
+# One approach would be to detect batch responses, then branch accordingly.
+# Either know in advance all the places that access tokens can appear, or use
+# something like jsonpath-rw to find them. But in fact access tokens only
+# appear in two forms in the JSON response:
+#
+#   "access_token":"..."  in JSON
+#   access_token=...      in paging URLs
+#
+# so it's much easier to use regular expression matching. Both forms, for
+# every field in the RESPONSE scope, are alternatives of a single pattern
+# (see fields.compile_token_re), which sub_access_tokens only tries where one
+# of the keys appears, so the body is scanned once.
+#
+# The pattern operates on bytes, so the body never needs to be decoded (and
+# doesn't need to be valid UTF-8). Variable-length escapes in the first form
+# handle nested JSON for batch responses.
+ACCESS_TOKEN_KEY = b'access_token'
+ACCESS_TOKEN_RE = compile_token_re(['access_token'])
+
+
+def sub_access_tokens(replace, body, keys=(ACCESS_TOKEN_KEY,),
+                      token_re=ACCESS_TOKEN_RE):
+    """
+    Equivalent to token_re.sub(replace, body), but jumps between occurrences
+    of the keys with find rather than attempting a match at every position in
+    the body. Returns the original body object when nothing was actually
+    replaced.
+    """
+    out = []
+    pos, changed = _sub_access_tokens(replace, body, out, None, keys, token_re)
+    if not changed:
+        return body
+    out.append(body[pos:])
+    return b''.join(out)
+
+
+def _sub_access_tokens(replace, body, out, limit=None,
+                       keys=(ACCESS_TOKEN_KEY,), token_re=ACCESS_TOKEN_RE):
+    """
+    Append body to out with tokens replaced, stopping before any match that
+    would start at or after limit. Returns (pos, changed) where pos is how far
+    into body has been appended to out.
+    """
+    pos = 0
+    changed = False
+    find = body.find
+    match = token_re.match if keys else None
+    # The next occurrence of each key. With several keys this is still a
+    # single pass per key with find, which is much faster than searching for
+    # an alternation of them with a regex.
+    single = len(keys) == 1
+    if single:
+        key = keys[0]
+    else:
+        nexts = [find(k) for k in keys]
+    while True:
+        if single:
+            i = find(key, pos)
+        else:
+            i = -1
+            for n, k in enumerate(keys):
+                j = nexts[n]
+                if 0 <= j < pos:
+                    j = nexts[n] = find(k, pos)
+                if j >= 0 and (i < 0 or j < i):
+                    i, key = j, k
+        if i < 0:
+            break
+        # Back up over the quote and escapes of the JSON form.
+        start = i
+        if start > pos and body[start - 1:start] == b'"':
+            start -= 1
+            while start > pos and body[start - 1:start] == b'\\':
+                start -= 1
+        if limit is not None and start >= limit:
+            break
+        m = match(body, start) or (start != i and match(body, i))
+        if m:
+            orig = m.group(0)
+            new = replace(m)
+            changed = changed or new != orig
+            out.append(body[pos:m.start()])
+            out.append(new)
+            pos = m.end()
+        else:
+            out.append(body[pos:i + len(key)])
+            pos = i + len(key)
+    return pos, changed
 
+
+# The streaming scanner holds back this much of the body between chunks, so
+# that a match spanning chunks is seen whole. Tokens are a few hundred bytes,
+# so this is plenty.
+STREAM_WINDOW = 16 * 1024
+
+
+class AccessTokenStream(object):
+    """
+    Apply sub_access_tokens to a body that arrives in chunks.
+
+    Call feed() with each chunk, then close() to get the filtered body.
+    Matches may span chunks, as long as they're no longer than the window.
+    """
+
+    def __init__(self, replace, window=STREAM_WINDOW, keys=(ACCESS_TOKEN_KEY,),
+                 token_re=ACCESS_TOKEN_RE):
+        self.replace = replace
+        self.window = window
+        self.keys = keys
+        self.token_re = token_re
+        self.changed = False
+        self._pending = b''
+        self._out = []
+
+    def feed(self, chunk):
+        buf = self._pending + chunk if self._pending else chunk
+        limit = len(buf) - self.window
+        if limit <= 0:
+            self._pending = buf
+            return
+        pos, changed = _sub_access_tokens(self.replace, buf, self._out, limit,
+                                          self.keys, self.token_re)
+        self.changed = self.changed or changed
+        cut = max(pos, limit)
+        self._out.append(buf[pos:cut])
+        self._pending = buf[cut:]
+
+    def close(self):
+        buf, self._pending = self._pending, b''
+        pos, changed = _sub_access_tokens(self.replace, buf, self._out, None,
+                                          self.keys, self.token_re)
+        self.changed = self.changed or changed
+        self._out.append(buf[pos:])
+        out, self._out = self._out, []
+        return b''.join(out)
+
+
+def make_token_replace(elides, elider_prefix, cache=None, counters=None):
+    """
+    Make a replace function for matches of a pattern from compile_token_re,
+    which elides each token with elides[name] (where name is bytes). If
+    counters is given then "elided.<name>" is incremented for each token
+    elided.
+    """
+    names = dict((k, k.decode('ascii')) for k in elides)
+
+    def _elide(name, token):
+        new = elide_bytes(token, elides[name], elider_prefix, cache,
+                          names[name])
+        if counters is not None and new is not token:
+            counters['elided.' + names[name]] += 1
+        return new
+
+    def replace(m):
+        if m.group(4) is not None:
+            return b''.join([m.group(1), _elide(m.group(3), m.group(4)),
+                             m.group(2)])
+        return b''.join([m.group(5), _elide(m.group(6), m.group(7))])
+
+    return replace
+
+
+def make_access_token_replace(elide_access_token, elider_prefix, cache=None):
+    return make_token_replace({ACCESS_TOKEN_KEY: elide_access_token},
+                              elider_prefix, cache)
+
+
+def filter_tokens(response, replace, keys=(ACCESS_TOKEN_KEY,),
+                  token_re=ACCESS_TOKEN_RE):
+    body = response['body']['string']
+    new_body = sub_access_tokens(replace, body, keys, token_re)
+    if new_body is not body:
+        response['body']['string'] = new_body
     return response
 
 
 def filter_access_tokens(response,
                          elide_access_token,
-                         elider_prefix):
+                         elider_prefix,
+                         cache=None):
+    return filter_tokens(response, make_access_token_replace(
+        elide_access_token, elider_prefix, cache))
 
-    # One approach would be to detect batch responses, then branch
-    # accordingly. Either know in advance all the places that access tokens
-    # can appear, or use something like jsonpath-rw to find them. But in
-    # fact access tokens only appear in two forms in the JSON response:
-    #
-    #   "access_token":"..."  in JSON
-    #   access_token=...      in paging URLs
-    #
-    # so it's much easier to use regular expression matching.
-
-    # Decode so unicode patterns can operate on the body.
-    body = response['body']['string'].decode('utf-8')
-
-    # Variable-length escapes here handle nested JSON for batch responses.
-    body = re.sub(
-        r'((\\*")access_token\2:\s*\2)([^\\"]+)\2',
-        lambda m: ''.join([
-            m.group(1),
-            elide(m.group(3), elide_access_token, elider_prefix),
-            m.group(2),
-        ]),
-        body,
-    )
 
-    body = re.sub(
-        r'(access_token=)([^\\&"]+)',
-        lambda m: ''.join([
-            m.group(1),
-            elide(m.group(2), elide_access_token, elider_prefix),
-        ]),
-        body,
-    )
+def ungzip_filter_tokens(response, replace, chunk_size,
+                         keys=(ACCESS_TOKEN_KEY,), token_re=ACCESS_TOKEN_RE):
+    """
+    Combined ungzip and filter_tokens for gzipped responses. The body is
+    inflated chunk_size bytes at a time, and each chunk is passed straight to
+    the token scanner, so there's never a full decompressed copy of the body
+    besides the filtered result.
+    """
+    headers, body = response['headers'], response['body']
+    if 'gzip' not in headers.get('content-encoding', []):
+        return filter_tokens(response, replace, keys, token_re)
 
-    response['body']['string'] = body.encode('utf-8')
+    stream = AccessTokenStream(replace, keys=keys, token_re=token_re)
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    compressed = body['string']
+    for i in range(0, len(compressed), chunk_size):
+        data = compressed[i:i + chunk_size]
+        while data:
+            stream.feed(d.decompress(data, chunk_size))
+            data = d.unconsumed_tail
+    stream.feed(d.flush())
+
+    body['string'] = stream.close()
+    _remove_gzip_encoding(headers)
     return response
 
 
-def elide(orig, fun, prefix):
+def ungzip_filter_access_tokens(response,
+                                elide_access_token,
+                                elider_prefix,
+                                chunk_size,
+                                cache=None):
+    return ungzip_filter_tokens(response, make_access_token_replace(
+        elide_access_token, elider_prefix, cache), chunk_size)
+
+
+def elide_bytes(orig, fun, prefix, cache=None, name='access_token'):
+    """
+    Like elide, but for a token found in a bytes body. Only the token itself
+    is decoded for the callback, and the result is encoded back to bytes.
+    """
+    try:
+        text = orig.decode('utf-8')
+    except UnicodeDecodeError:
+        text = orig.decode('latin-1')
+    value = elide(text, fun, prefix, cache, name)
+    if value == text:
+        return orig
+    return value.encode('utf-8')
+
+
+def elide(orig, fun, prefix, cache=None, name='access_token'):
     if prefix and orig.startswith(prefix):
         return orig
+    if cache is not None:
+        return cache.get((name, orig), lambda: elide(orig, fun, prefix))
     value = None
     if fun:
         value = fun(orig)
@@ -0,0 +1,86 @@
+from __future__ import absolute_import, unicode_literals, print_function
+
+import atexit
+import collections
+import sys
+import threading
+from timeit import default_timer
+
+from .compat import OrderedDict
+
+
+class Stats(object):
+    """
+    Totals collected from the before_record and before_record_response hooks
+    when they're built with stats (see get_vcr_kwargs).
+
+    Each pipeline stage is timed as "request.<stage>" or "response.<stage>",
+    along with the size of the body going in and out of it. The counters are
+    the ones the pipelines already keep (fast path skips, responses skipped
+    by content-type or size) plus "<pipeline>.skipped" for transactions the
+    pipeline doesn't apply to, "body.unparsed" for bodies that looked
+    sensitive but didn't parse, and "elided.<field>" for each value elided.
+    """
+
+    timer = staticmethod(default_timer)
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self._timings = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, bytes_in=None, bytes_out=None):
+        with self._lock:
+            t = self._timings.get(name)
+            if t is None:
+                t = self._timings[name] = [0, 0.0, 0, 0]
+            t[0] += 1
+            t[1] += seconds
+            t[2] += bytes_in or 0
+            t[3] += bytes_out or 0
+
+    def timings(self):
+        """
+        Return a dict of stage name to a dict of calls, seconds, bytes_in and
+        bytes_out.
+        """
+        with self._lock:
+            return OrderedDict(
+                (name, dict(calls=t[0], seconds=t[1], bytes_in=t[2],
+                            bytes_out=t[3]))
+                for name, t in self._timings.items()
+            )
+
+    def summary(self):
+        return dict(counters=dict(self.counters), timings=self.timings())
+
+    def reset(self):
+        with self._lock:
+            self._timings.clear()
+            self.counters.clear()
+
+    def format(self):
+        lines = ['{0:<32} {1:>8} {2:>10} {3:>12} {4:>12}'.format(
+            'stage', 'calls', 'ms', 'bytes in', 'bytes out')]
+        for name, t in self.timings().items():
+            lines.append('{0:<32} {1:>8} {2:>10.1f} {3:>12} {4:>12}'.format(
+                name, t['calls'], t['seconds'] * 1000, t['bytes_in'],
+                t['bytes_out']))
+        if self.counters:
+            lines.append('')
+            for name, count in sorted(self.counters.items()):
+                lines.append('{0:<32} {1:>8}'.format(name, count))
+        return '\n'.join(lines)
+
+    def dump(self, file=None):
+        print(self.format(), file=file or sys.stderr)
+
+    def dump_at_exit(self, file=None):
+        """
+        Dump the summary when the interpreter exits, typically at the end of
+        a test session.
+        """
+        atexit.register(self.dump, file)
+
+    def __repr__(self):
+        return '<{0} {1}>'.format(type(self).__name__, self.summary())
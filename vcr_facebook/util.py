@@ -7,3 +7,34 @@ def always_return(x):
 
 def identity(x, *args, **kwargs):
     return x
+
+
+def get_header(headers, name, default=''):
+    """
+    Case-insensitive header lookup. VCR.py's HeadersDict is already
+    case-insensitive, but a plain dict might not be.
+    """
+    value = headers.get(name)
+    if value is None:
+        name = name.lower()
+        for k, v in headers.items():
+            if k.lower() == name:
+                value = v
+                break
+        else:
+            return default
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else default
+    return value
+
+
+def set_header(headers, name, value):
+    """
+    Set a header, replacing it under whatever case it already has.
+    """
+    lower = name.lower()
+    for k in list(headers):
+        if k.lower() == lower:
+            name = k
+            break
+    headers[name] = value